@@ -7,11 +7,36 @@
 '''
   持久化缓存
 '''
+import os
 import time
+import copy
+import math
+import random
+import mmap
+import fcntl
+import struct
+import hashlib
+import datetime
+import zlib
+import cPickle as pickle
 import asyncmongo
+import utils
+from bson import BSON
+from bson.son import SON
+from bson.binary import Binary
+from collections import OrderedDict
 from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.stack_context import ExceptionStackContext
+from tornado.log import app_log
+from tornado.escape import json_encode, json_decode, utf8
 
-__all__ = ['Mongod']
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ['Error', 'namespace', 'tag_key', 'codecs', 'Stats', 'Base', 'Mongod', 'Tiered', 'InProcess', 'SharedMemory']
 
 '''
 基于 asyncmongo 的异步缓存
@@ -36,84 +61,1231 @@ class Handler(RequestHandler):
         # 删缓存
         ret = yield gen.Task(mongod.remove, 'test2')
         print ret
+        # 批量读写, 一次往返
+        count = yield gen.Task(mongod.set_many, {'a': 1, 'b': 2}, 3600)
+        data = yield gen.Task(mongod.get_many, ['a', 'b', 'c'])
+        print data # {'a': 1, 'b': 2}
+        count = yield gen.Task(mongod.delete_many, ['a', 'b'])
+        # 带标签写入, 按标签整体失效
+        yield gen.Task(mongod.set, 'post:1', {'title': 'hi'}, 3600, tags=['user:1'])
+        yield gen.Task(mongod.invalidate_tag, 'user:1')
 
 ```
 
 '''
 
 
-class Mongod(object):
+class Error(Exception):
+    pass
+
+# 区分 "没有缓存" 与 "缓存值为 default"
+_MISSING = object()
+
+
+def namespace(key):
+    '''
+    缓存 key 的命名空间, 即第一个 `:` 之前的部分, 没有则为空字符串
+    '''
+    if not isinstance(key, basestring):
+        key = str(key)
+    if ':' not in key:
+        return ''
+    return key.split(':', 1)[0]
+
+
+def tag_key(tag):
+    '''
+    标签的代数计数器存放在这个 key 下
+    '''
+    return '__tag__:%s' % tag
+
+
+def _msgpack_dumps(val):
+    if not msgpack:
+        raise Error('msgpack is not installed')
+    return msgpack.packb(val)
+
+
+def _msgpack_loads(data):
+    if not msgpack:
+        raise Error('msgpack is not installed')
+    return msgpack.unpackb(data)
+
+
+# 缓存值的序列化方式
+codecs = {
+    'pickle' : (lambda val: pickle.dumps(val, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    'json' : (json_encode, json_decode),
+    'msgpack' : (_msgpack_dumps, _msgpack_loads),
+}
+
+
+class Stats(object):
+    '''
+    缓存统计, 按命名空间(见 `namespace`)分别计数
+    ============================
+
+     - hits / misses: 命中 / 未命中次数, expired 为其中因过期或标签失效而未命中的次数
+     - sets / removes: 写入 / 删除的条数
+     - evicted: 因超出容量被淘汰的条数
+     - bytes_read / bytes_written: 命中 / 写入的值的字节数 (后端可得时才统计;
+       Mongod 只统计经 codec 编码的值, 配置 `count_bytes` 为 True 时才另外编码普通值来计数)
+     - latency: 各操作耗时的直方图, 单位毫秒
+    '''
+
+    # 直方图的桶上限(毫秒), 最后一个桶为 "更慢"
+    buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._data = {}
+
+    def _namespace(self, key):
+        ns = namespace(key)
+        if ns not in self._data:
+            self._data[ns] = {
+                'hits' : 0,
+                'misses' : 0,
+                'expired' : 0,
+                'sets' : 0,
+                'removes' : 0,
+                'evicted' : 0,
+                'bytes_read' : 0,
+                'bytes_written' : 0,
+                'latency' : {},
+            }
+        return self._data[ns]
+
+    def incr(self, key, event, size=0):
+        if not self.enabled:
+            return
+        data = self._namespace(key)
+        data[event] += 1
+        if size:
+            if event == 'hits':
+                data['bytes_read'] += size
+            else:
+                data['bytes_written'] += size
+
+    def timing(self, key, op, start_time):
+        if not self.enabled:
+            return
+        latency = self._namespace(key)['latency']
+        if op not in latency:
+            latency[op] = {
+                'count' : 0,
+                'total' : 0.0,
+                'histogram' : [0] * (len(self.buckets) + 1),
+            }
+        ms = (time.time() - start_time) * 1000
+        item = latency[op]
+        item['count'] += 1
+        item['total'] += ms
+        for i, bucket in enumerate(self.buckets):
+            if ms <= bucket:
+                item['histogram'][i] += 1
+                break
+        else:
+            item['histogram'][-1] += 1
+
+    def timing_many(self, keys, op, start_time):
+        # 批量操作在涉及的每个命名空间各记一次
+        for key in dict([(namespace(key), key) for key in keys]).values():
+            self.timing(key, op, start_time)
+
+    def snapshot(self):
+        '''
+        当前统计的副本, 附带命中率和平均耗时, 可直接输出为 json
+        '''
+        ret = copy.deepcopy(self._data)
+        for ns, data in ret.items():
+            total = data['hits'] + data['misses']
+            data['hit_rate'] = round(float(data['hits']) / total, 4) if total else None
+            for op, item in data['latency'].items():
+                item['avg'] = round(item['total'] / item['count'], 3) if item['count'] else 0
+                item['buckets'] = list(self.buckets)
+        return ret
+
+    def reset(self):
+        self._data = {}
+
+
+class Base(object):
+    '''
+    缓存基类
+    '''
+
+    def __init__(self, stats=True):
+        # 正在计算中的 key 及等待结果的回调
+        self._flights = {}
+        self._stats = Stats(stats)
+
+    def stats(self):
+        '''
+        按命名空间的命中 / 耗时 / 字节数统计, 见 `Stats`
+
+        ``` python
+
+        class CacheStatsHandler(RequestHandler):
+            def get(self):
+                self.write(self.application.cache.stats())
+
+        ```
+        '''
+        return self._stats.snapshot()
+
+    def get_or_compute(self, key, producer, left_time=-1, callback=None, beta=0):
+        '''
+        读缓存, 未命中时调用 `producer(callback)` 计算并写入缓存。
+
+        同一进程内同一个 key 的并发未命中只会运行一次 producer, 其它请求共享结果。
+        `beta` > 0 时按概率提前刷新(越接近过期、计算越慢, 概率越大),
+        提前刷新时先返回旧值, 在后台重新计算, 避免各进程同时过期。
+
+        缓存中存放的是带计算耗时和过期时间的包装, 这类 key 应始终通过本方法读取。
+
+        读取或 producer 出错时异常抛给发起计算的请求, 其它等待的请求重新读取;
+        后台提前刷新出错时只记录日志。
+
+        ``` python
+
+        def load_posts(callback=None):
+            ...
+
+        posts = yield gen.Task(cache.get_or_compute, 'posts:index', load_posts, 600, beta=1)
+
+        ```
+        '''
+        waiters = self._flights.get(key)
+        if waiters is not None:
+            waiters.append(callback)
+            return
+        waiters = self._flights[key] = [callback]
+
+        def _failed(typ, value, tb):
+            # 出错时结束这次计算, 等待的请求重新读取, 异常继续抛给发起的请求
+            if self._flights.get(key) is waiters:
+                del self._flights[key]
+                for cb in waiters[1:]:
+                    IOLoop.current().add_callback(self.get_or_compute, key, producer,
+                                                  left_time, cb, beta)
+            return False
+
+        def _refresh_failed(typ, value, tb):
+            self._flights.pop(('refresh', key), None)
+            app_log.error('refresh cache %r failed', key, exc_info=(typ, value, tb))
+            return True
+
+        def _done(val):
+            for cb in self._flights.pop(key, []):
+                if cb:
+                    cb(val)
+
+        def _compute(on_value):
+            start_time = time.time()
+
+            def _produced(val):
+                this_time = time.time()
+                self.set(key, {
+                    '_v' : val,
+                    '_d' : this_time - start_time,
+                    '_e' : this_time + left_time if left_time >= 0 else None,
+                }, left_time)
+                on_value(val)
+
+            producer(callback=_produced)
+
+        def _refreshed(val):
+            self._flights.pop(('refresh', key), None)
+
+        def _callback(item):
+            if not isinstance(item, dict) or '_v' not in item:
+                return _compute(_done)
+
+            if beta > 0 and item.get('_e') and ('refresh', key) not in self._flights:
+                # XFetch: now - delta * beta * ln(rand) >= expire 时提前刷新
+                gap = -item['_d'] * beta * math.log(random.random() or 1e-12)
+                if time.time() + gap >= item['_e']:
+                    self._flights[('refresh', key)] = []
+                    with ExceptionStackContext(_refresh_failed):
+                        _compute(_refreshed)
+
+            _done(item['_v'])
+
+        with ExceptionStackContext(_failed):
+            self.get(key, _MISSING, callback=_callback)
+
+
+class Mongod(Base):
+    '''
+    过期时间以绝对时间存放在 `expire_at` 字段, 并建有 TTL 索引,
+    过期的缓存由 mongod 自行清理; 读取时在查询条件中过滤已过期的记录。
+    永久缓存(left_time = -1)的 `expire_at` 为 None, TTL 索引不会处理。
+
+    ## 序列化:
+
+    默认按 BSON 子文档存放 `val`; 配置了序列化方式(pickle / json / msgpack)时,
+    `val` 以二进制存放, 超过 `compress_threshold` 字节的自动用 zlib 压缩。
+    可按命名空间(key 中第一个 `:` 之前的部分)分别指定:
+
+    ``` python
+
+    'config': {
+        'codec': 'pickle',
+        'codecs': {'fragment': 'msgpack', 'plugin': None},
+        'compress_threshold': 1024,
+    }
+
+    ```
+
+    ## 标签:
+
+    `set` 时可指定 `tags`, 记录下各标签当前的代数; `invalidate_tag` 只把标签的代数加一,
+    带该标签的缓存在读取时发现代数不符即视为失效, 无需扫描或逐条删除。
+    要整体失效一个命名空间, 可把命名空间本身作为标签。
+    带标签的缓存读取时多一次查询, 不带标签的不受影响。
+
+    ## 写确认:
+
+    `safe` 默认为 True, 每次写入都等待 getLastError 确认;
+    设为 False 时写入不确认, 发出即回调(批量操作回调的条数为请求的条数),
+    适合可丢失的缓存写入; 也可以是 getLastError 的参数, 如 `{'w': 2, 'wtimeout': 100}`。
+
+    ## 容量:
+
+    配置 `max_entries` (条数) 或 `max_bytes` (集合数据大小) 后, 每 `evict_interval` 秒
+    在后台检查一次集合大小, 超出时按最近访问时间淘汰最旧的缓存(近似 LRU),
+    每批 `evict_chunk` 条, 批与批之间让出 IOLoop。
+    访问时间在读取时更新, 同一条缓存 `access_resolution` 秒内最多更新一次, 且不等待确认。
+    标签计数器没有访问时间, 不会被淘汰。
+
+    ## 旧版本数据:
+
+    旧版本写入的记录只有 `left_time` / `update_time`, 启动时在后台分批补上
+    `expire_at` 和 `access_time`; 补齐之前读取时按原来的方式判断是否过期。
+    '''
 
     def __init__(self, **kwargs):
+        Base.__init__(self, kwargs.get('stats', True))
+        self._dbname = kwargs.get('dbname', 'cache')
         self._conn = asyncmongo.Client(
             pool_id = kwargs.get('pool_id', 'xcat.cache.Mongod'), 
             host = kwargs.get('host', '127.0.0.1'), 
             port = kwargs.get('port', 27017), 
             maxcached = kwargs.get('maxcached', 10), 
             maxconnections = kwargs.get('maxconnections', 50), 
-            dbname = kwargs.get('dbname', 'cache'),
+            dbname = self._dbname,
             dbuser = kwargs.get('dbuser', None),
             dbpass = kwargs.get('dbpass', None)
         )
 
         self._table = kwargs.get('table', 'caches')
+        self._codec = kwargs.get('codec', None)
+        self._codecs = kwargs.get('codecs', {})
+        self._compress_threshold = int(kwargs.get('compress_threshold', 1024))
+        self._compress_level = int(kwargs.get('compress_level', 6))
+        self._safe = kwargs.get('safe', True)
+        self._max_entries = int(kwargs.get('max_entries', 0))
+        self._max_bytes = int(kwargs.get('max_bytes', 0))
+        self._evict_chunk = int(kwargs.get('evict_chunk', 500))
+        self._access_resolution = int(kwargs.get('access_resolution', 60))
+        # 是否为统计字节数而编码未经 codec 的值
+        self._count_bytes = kwargs.get('count_bytes', False)
+        self._evicting = False
+        self._ensure_indexes()
+        self._backfill()
+
+        if self._max_entries or self._max_bytes:
+            self._evict_timer = PeriodicCallback(
+                self._evict, int(kwargs.get('evict_interval', 60)) * 1000)
+            self._evict_timer.start()
+
+    def _ensure_index(self, field, **options):
+        utils.Mongo.ensure_index(self._conn, self._dbname, self._table, field, **options)
+
+    def _ensure_indexes(self):
+        # 唯一索引, 同时清理旧版本写入的重复 key
+        self._ensure_index('key', unique=True, dropDups=True)
+        # 过期的缓存由 mongod 的 TTL 线程清理
+        self._ensure_index('expire_at', expireAfterSeconds=0)
+        # 按访问时间淘汰
+        self._ensure_index('access_time')
+
+    def _write(self, op, *args, **kwargs):
+        # 按缓存配置的 safe 写入
+        utils.Mongo.write(self._conn[self._table], self._safe, op, *args, **kwargs)
+
+    @staticmethod
+    def _expire_at(left_time):
+        if int(left_time) < 0:
+            return None
+        return datetime.datetime.utcfromtimestamp(time.time() + int(left_time))
+
+    def _backfill(self):
+        # 给旧版本写入的记录补上 expire_at / access_time, 过期的由 TTL 索引清理
+        def _update(doc):
+            left_time = int(doc['left_time'])
+            update_time = int(doc.get('update_time', 0))
+            expire_at = None
+            if left_time >= 0:
+                expire_at = datetime.datetime.utcfromtimestamp(update_time + left_time)
+            return {'$set' : {'expire_at' : expire_at, 'access_time' : update_time}}
+
+        utils.Mongo.backfill(self._conn, self._table,
+                             {'expire_at' : {'$exists' : False}, 'left_time' : {'$exists' : True}},
+                             {'left_time' : 1, 'update_time' : 1},
+                             _update, self._evict_chunk)
+
+    @staticmethod
+    def _expired(doc):
+        # 尚未补齐 expire_at 的旧记录, 按 update_time + left_time 判断
+        if 'expire_at' in doc or 'left_time' not in doc:
+            return False
+        left_time = int(doc['left_time'])
+        return left_time >= 0 and int(doc.get('update_time', 0)) + left_time < time.time()
+
+    def _drop_expired(self, docs):
+        # 去掉并删除过期的旧记录
+        expired = [doc['_id'] for doc in docs if self._expired(doc)]
+        if expired:
+            self._conn[self._table].remove({'_id' : {'$in' : expired}}, safe=False)
+        return [doc for doc in docs if not self._expired(doc)]
+
+    @staticmethod
+    def _alive(where):
+        # 只匹配未过期的记录 (TTL 线程每分钟才清理一次)
+        where['$or'] = [
+            {'expire_at' : None},
+            {'expire_at' : {'$gt' : datetime.datetime.utcnow()}},
+        ]
+        return where
+
+    def _document(self, key, val, expire_at, this_time, tags=None):
+        doc = {
+            'key' : key,
+            'val' : val,
+            'expire_at' : expire_at,
+            'update_time' : this_time,
+            'access_time' : this_time,
+        }
+        if tags:
+            doc['tags'] = tags
+
+        codec = self._codecs.get(namespace(key), self._codec)
+        if codec:
+            data = codecs[codec][0](val)
+            if len(data) > self._compress_threshold:
+                data = zlib.compress(data, self._compress_level)
+                doc['zip'] = True
+            doc['val'] = Binary(data)
+            doc['codec'] = codec
+
+        return doc
+
+    def _size(self, doc):
+        # 值的字节数, 仅用于统计
+        if not self._stats.enabled:
+            return 0
+        if doc.get('codec'):
+            return len(doc['val'])
+        if not self._count_bytes:
+            return 0
+        return len(BSON.encode({'val': doc['val']}))
+
+    @staticmethod
+    def _value(doc):
+        codec = doc.get('codec')
+        if not codec:
+            return doc['val']
+
+        data = str(doc['val'])
+        if doc.get('zip'):
+            data = zlib.decompress(data)
+        return codecs[codec][1](data)
+
+    def _tag_gens(self, tags, callback):
+        # 取标签当前的代数, 回调 [[tag, generation], ...]
+        tags = list(tags or [])
 
-    def get(self, key, default=None, callback=None):
         def _callback(data, error):
             if error:
                 raise Error(error)
-            if data:
-                last_time = int(data['update_time']) + int(data['left_time'])
 
-                if int(data['left_time']) == -1 or int(time.time()) <= last_time:       
-                    return callback(data['val'])
-                else:
-                    self.remove(key)
+            gens = dict([(v['key'], v.get('gen', 0)) for v in data or []])
+            callback([[tag, gens.get(tag_key(tag), 0)] for tag in tags])
 
-            callback(default)
+        if not tags:
+            return callback(None)
+
+        keys = [tag_key(tag) for tag in tags]
+        self._conn[self._table].find({'key': {'$in': keys}},
+                                     limit=len(keys), callback=_callback)
+
+    def _check_tags(self, docs, callback):
+        # 过滤掉标签已失效的记录
+        tags = set()
+        for doc in docs:
+            for tag, generation in doc.get('tags') or []:
+                tags.add(tag)
+
+        def _valid(doc, gens):
+            for tag, generation in doc.get('tags') or []:
+                if gens.get(tag) != generation:
+                    return False
+            return True
+
+        def _callback(tag_gens):
+            gens = dict([(tag, generation) for tag, generation in tag_gens])
+            callback([doc for doc in docs if _valid(doc, gens)])
+
+        if not tags:
+            return callback(docs)
+
+        self._tag_gens(tags, _callback)
+
+    @property
+    def access_resolution(self):
+        # 访问时间的更新精度(秒)
+        return self._access_resolution
 
-        self._conn[self._table].find_one({'key': key}, callback=_callback)    
+    def _touch(self, docs):
+        # 更新访问时间, 供淘汰时参考; 有精度限制且不等待确认
+        this_time = int(time.time())
+        self.touch([doc['key'] for doc in docs
+                    if this_time - doc.get('access_time', 0) >= self._access_resolution])
+
+    def touch(self, keys):
+        '''
+        更新访问时间, 不等待确认; 供上一级缓存(如 Tiered)命中时转发。
+        未配置容量时不做任何事。
+        '''
+        if not (self._max_entries or self._max_bytes):
+            return
+        keys = list(keys)
+        if keys:
+            self._conn[self._table].update({
+                'key' : {'$in' : keys}
+            }, {
+                '$set' : {'access_time' : int(time.time())}
+            }, multi=True, safe=False)
 
     @gen.engine
-    def set(self, key, val, left_time=-1, callback=None):
+    def _evict(self):
+        if self._evicting:
+            return
+        self._evicting = True
+        try:
+            ret, error = yield gen.Task(self._conn['$cmd'].find_one,
+                                        SON([('collStats', self._table)]))
+            data = ret[0]
+            if error.get('error') or not data or not data.get('ok'):
+                return
+
+            excess = 0
+            if self._max_entries:
+                excess = int(data.get('count', 0)) - self._max_entries
+            if self._max_bytes and data.get('size', 0) > self._max_bytes:
+                avg_size = max(int(data.get('avgObjSize', 0)), 1)
+                excess = max(excess,
+                             int(math.ceil(float(data['size'] - self._max_bytes) / avg_size)))
+
+            while excess > 0:
+                ret, error = yield gen.Task(self._conn[self._table].find, {
+                    'access_time' : {'$lte' : int(time.time())}
+                }, fields={'key' : 1}, sort=[('access_time', 1)],
+                   limit=min(excess, self._evict_chunk))
+                docs = ret[0]
+                if error.get('error') or not docs:
+                    break
+
+                keys = [doc['key'] for doc in docs]
+                yield gen.Task(self._write, 'remove', {'key' : {'$in' : keys}})
+                for key in keys:
+                    self._stats.incr(key, 'evicted')
+                excess -= len(keys)
+
+                # 让出 IOLoop, 不阻塞正常请求
+                yield gen.Task(IOLoop.instance().add_callback)
+        finally:
+            self._evicting = False
+
+    def get(self, key, default=None, callback=None):
+        start_time = time.time()
+
+        def _checked(docs):
+            self._stats.timing(key, 'get', start_time)
+            if docs:
+                self._stats.incr(key, 'hits', self._size(docs[0]))
+                self._touch(docs)
+                return callback(self._value(docs[0]))
+
+            # 标签已失效
+            self._stats.incr(key, 'misses')
+            self._stats.incr(key, 'expired')
+            callback(default)
+
+        def _callback(data, error):
+            if error:
+                raise Error(error)
+            if data and self._drop_expired([data]):
+                return self._check_tags([data], _checked)
+
+            self._stats.timing(key, 'get', start_time)
+            self._stats.incr(key, 'misses')
+            callback(default)
+
+        self._conn[self._table].find_one(self._alive({'key': key}), callback=_callback)    
+
+    def set(self, key, val, left_time=-1, callback=None, tags=None):
+        start_time = time.time()
+
         def _callback(data, error):
             if error:
                 raise Error(error)
 
+            self._stats.timing(key, 'set', start_time)
             if callback:
                 callback(len(data) == 1)
 
-        ret, error = yield gen.Task(self._conn[self._table].find_one, {'key': key})
-        data = ret[0]
-        if not data or len(data) == 0:
-            self._conn[self._table].insert({
-                'key' : key,
-                'val' : val,
-                'left_time' : int(left_time),
-                'update_time' : int(time.time()), 
-            }, callback=_callback)
-        else:
-            self._conn[self._table].update({
-                '_id' : data['_id']
-            },{
-                'key' : key,
-                'val' : val,
-                'left_time' : int(left_time),
-                'update_time' : int(time.time()), 
-            }, upsert=True, safe=True, callback=_callback)
+        def _update(tag_gens):
+            doc = self._document(key, val, self._expire_at(left_time), int(time.time()), tag_gens)
+            self._stats.incr(key, 'sets', self._size(doc))
+            # 以 key 为条件 upsert, 一次往返, 并发写入也不会产生重复的 key
+            self._write('update', {
+                'key' : key
+            }, doc, upsert=True, callback=_callback)
+
+        self._tag_gens(tags, _update)
+
+    def invalidate_tag(self, tag, callback=None):
+        '''
+        使带有该标签的缓存全部失效
+        '''
+        def _callback(data, error):
+            if error:
+                raise Error(error)
+
+            if callback:
+                callback(len(data) == 1)
+
+        self._write('update', {
+            'key' : tag_key(tag)
+        }, {
+            '$inc' : {'gen' : 1}
+        }, upsert=True, callback=_callback)
 
     def remove(self, key, callback=None):
+        start_time = time.time()
+
         def _callback(data, error):
             if error:
                 raise Error(error)
 
+            self._stats.timing(key, 'remove', start_time)
+            self._stats.incr(key, 'removes')
             if callback:
                 callback(len(data) == 1)
 
-        self._conn[self._table].remove({
+        self._write('remove', {
             'key' : key
         }, callback=_callback)
 
+    def get_many(self, keys, callback=None):
+        '''
+        批量读缓存, 一次 $in 查询, 回调 {key: val}, 不存在的 key 不返回
+        '''
+        keys = list(keys)
+        start_time = time.time()
+
+        def _checked(docs):
+            self._stats.timing_many(keys, 'get_many', start_time)
+            data = {}
+            for v in docs:
+                self._stats.incr(v['key'], 'hits', self._size(v))
+                data[v['key']] = self._value(v)
+            for key in keys:
+                if key not in data:
+                    self._stats.incr(key, 'misses')
+            self._touch(docs)
+            callback(data)
+
+        def _callback(data, error):
+            if error:
+                raise Error(error)
+
+            self._check_tags(self._drop_expired(data or []), _checked)
+
+        if not keys:
+            return callback({})
+
+        self._conn[self._table].find(self._alive({'key': {'$in': keys}}),
+                                     limit=len(keys), callback=_callback)
+
+    def set_many(self, mapping, left_time=-1, callback=None, tags=None):
+        '''
+        批量写缓存, 使用 update 命令一次提交全部 upsert (需要 mongod 2.6+),
+        回调写入的条数
+        '''
+        start_time = time.time()
+
+        def _callback(data, error):
+            if error:
+                raise Error(error)
+            if not data.get('ok'):
+                raise Error(data.get('errmsg', data))
+
+            self._stats.timing_many(mapping.keys(), 'set_many', start_time)
+            if callback:
+                callback(int(data.get('n', 0)))
+
+        def _update(tag_gens):
+            this_time = int(time.time())
+            expire_at = self._expire_at(left_time)
+            updates = []
+            for key, val in mapping.items():
+                doc = self._document(key, val, expire_at, this_time, tag_gens)
+                self._stats.incr(key, 'sets', self._size(doc))
+                updates.append({
+                    'q' : {'key' : key},
+                    'u' : doc,
+                    'upsert' : True,
+                })
+
+            command = SON([
+                ('update', self._table),
+                ('updates', updates),
+                ('ordered', False),
+            ])
+            if not self._safe:
+                # 命令总会有响应, 不确认时不等待
+                command['writeConcern'] = {'w' : 0}
+                self._conn['$cmd'].find_one(command, callback=lambda *args, **kwargs: None)
+                return _callback({'ok' : 1, 'n' : len(updates)}, None)
+
+            if isinstance(self._safe, dict):
+                command['writeConcern'] = self._safe
+            self._conn['$cmd'].find_one(command, callback=_callback)
+
+        if not mapping:
+            if callback:
+                callback(0)
+            return
+
+        self._tag_gens(tags, _update)
+
+    def delete_many(self, keys, callback=None):
+        '''
+        批量删缓存, 回调删除的条数
+        '''
+        keys = list(keys)
+        start_time = time.time()
+
+        def _callback(data, error):
+            if error:
+                raise Error(error)
+
+            self._stats.timing_many(keys, 'delete_many', start_time)
+            for key in keys:
+                self._stats.incr(key, 'removes')
+            if callback:
+                callback(int(data[0].get('n', len(keys))) if data else 0)
+
+        if not keys:
+            if callback:
+                callback(0)
+            return
+
+        self._write('remove', {
+            'key' : {'$in' : keys}
+        }, callback=_callback)
+
+
+class _LRU(object):
+    '''
+    带容量上限的 LRU 表, 只在进程内使用
+    '''
+
+    def __init__(self, max_size=1000):
+        self.max_size = int(max_size)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        # 移到队尾, 表示最近使用
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        if key in self._data:
+            del self._data[key]
+        elif len(self._data) >= self.max_size:
+            # 淘汰最久未使用的
+            self._data.popitem(last=False)
+        self._data[key] = value
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def items(self):
+        return self._data.items()
+
+
+
+class Tiered(Base):
+    '''
+    两级缓存
+    ============================
+
+    进程内的 LRU + TTL 缓存挡在持久化缓存(如 Mongod)前面,
+    读穿透(read-through), 写穿透(write-through)。
+
+    本地缓存只在当前进程有效, 其它进程写入的数据最多会晚 `left_time` 秒可见;
+    对一致性要求更高的读取, 可用 `max_stale` 缩短可接受的陈旧时间(0 表示直接读后端)。
+    `invalidate_tag` 会清空当前进程的本地缓存, 其它进程同样最多晚 `left_time` 秒生效。
+    后端支持 `touch` 时(如 Mongod), 本地命中每 `access_resolution` 秒转发一次访问,
+    后端按访问时间淘汰时不会误删热点缓存。
+
+    ## 配置:
+
+    ``` python
+
+    'cache': {
+        'storage': 'Mongod',
+        'config': {},
+        # 开启进程内缓存
+        'local': {'max_size': 1000, 'left_time': 5},
+    }
+
+    ```
+    '''
+
+    def __init__(self, storage, max_size=1000, left_time=5, stats=True):
+        Base.__init__(self, stats)
+        self.storage = storage
+        self.left_time = int(left_time)
+        self._local = _LRU(max_size)
+        self._access_resolution = getattr(storage, 'access_resolution', 60)
+
+    def _store(self, key, val, left_time=-1):
+        this_time = time.time()
+        local_time = self.left_time
+        if int(left_time) > 0:
+            local_time = min(local_time, int(left_time))
+
+        # 过期时间, 写入时间, 值, 上次转发访问的时间
+        self._local.put(key, (this_time + local_time, this_time, copy.deepcopy(val), this_time))
+
+    def _touch(self, items, this_time):
+        # 本地命中时按精度把访问转发给后端, 避免后端淘汰热点缓存
+        if not hasattr(self.storage, 'touch'):
+            return
+        keys = []
+        for key, item in items:
+            if this_time - item[3] >= self._access_resolution:
+                self._local.put(key, item[:3] + (this_time,))
+                keys.append(key)
+        if keys:
+            self.storage.touch(keys)
+
+    def get(self, key, default=None, callback=None, max_stale=None):
+        start_time = time.time()
+        item = self._local.get(key)
+        if item:
+            expire_time, store_time, val = item[:3]
+            if start_time < expire_time and \
+               (max_stale is None or start_time - store_time <= max_stale):
+                self._stats.incr(key, 'hits')
+                self._stats.timing(key, 'get', start_time)
+                self._touch([(key, item)], start_time)
+                return callback(copy.deepcopy(val))
+            self._local.pop(key)
+
+        def _callback(val):
+            self._stats.timing(key, 'get', start_time)
+            if val is _MISSING:
+                self._stats.incr(key, 'misses')
+                return callback(default)
+            self._stats.incr(key, 'hits')
+            self._store(key, val)
+            callback(val)
+
+        self.storage.get(key, _MISSING, callback=_callback)
+
+    def set(self, key, val, left_time=-1, callback=None, tags=None):
+        self._stats.incr(key, 'sets')
+        self._store(key, val, left_time)
+        self.storage.set(key, val, left_time, callback=callback, tags=tags)
+
+    def invalidate_tag(self, tag, callback=None):
+        # 从后端读入的缓存不知道带了哪些标签, 直接清空本地缓存
+        self._local.clear()
+        self.storage.invalidate_tag(tag, callback=callback)
+
+    def remove(self, key, callback=None):
+        self._stats.incr(key, 'removes')
+        self._local.pop(key)
+        self.storage.remove(key, callback=callback)
+
+    def get_many(self, keys, callback=None):
+        keys = list(keys)
+        start_time = time.time()
+        data = {}
+        misses = []
+        hits = []
+        for key in keys:
+            item = self._local.get(key)
+            if item and start_time < item[0]:
+                data[key] = copy.deepcopy(item[2])
+                hits.append((key, item))
+            else:
+                misses.append(key)
+        self._touch(hits, start_time)
+
+        def _callback(values):
+            for key, val in values.items():
+                self._store(key, val)
+            data.update(values)
+            self._stats.timing_many(keys, 'get_many', start_time)
+            for key in keys:
+                self._stats.incr(key, 'hits' if key in data else 'misses')
+            callback(data)
+
+        if not misses:
+            return _callback({})
+
+        self.storage.get_many(misses, callback=_callback)
+
+    def set_many(self, mapping, left_time=-1, callback=None, tags=None):
+        for key, val in mapping.items():
+            self._stats.incr(key, 'sets')
+            self._store(key, val, left_time)
+        self.storage.set_many(mapping, left_time, callback=callback, tags=tags)
+
+    def delete_many(self, keys, callback=None):
+        keys = list(keys)
+        for key in keys:
+            self._stats.incr(key, 'removes')
+            self._local.pop(key)
+        self.storage.delete_many(keys, callback=callback)
+
+class _Tagged(object):
+    '''
+    带标签的缓存值, 记录写入时各标签的代数
+    '''
+
+    def __init__(self, val, tags):
+        self.val = val
+        self.tags = tags
+
+
+class _Local(Base):
+    '''
+    本机缓存的基类, 子类实现同步的 `_get`, `_set`, `_remove`,
+    对外提供与 Mongod 一致的回调接口
+    '''
+
+    @staticmethod
+    def _expire_time(left_time):
+        if int(left_time) < 0:
+            return 0
+        return time.time() + int(left_time)
+
+    def _tag_gens(self, tags):
+        tag_gens = []
+        for tag in tags:
+            found, generation = self._get(tag_key(tag))
+            if not found:
+                # 计数器可能被淘汰, 以时间作为初始代数, 不会与被淘汰前的代数重复
+                generation = int(time.time() * 1000)
+                self._set(tag_key(tag), generation, 0)
+            tag_gens.append((tag, generation))
+        return tag_gens
+
+    def _fetch(self, key):
+        found, val = self._get(key)
+        if found and isinstance(val, _Tagged):
+            for tag, generation in val.tags:
+                # 计数器不存在也视为失效
+                if self._get(tag_key(tag)) != (True, generation):
+                    self._stats.incr(key, 'expired')
+                    return False, None
+            val = val.val
+        return found, val
+
+    def get(self, key, default=None, callback=None):
+        start_time = time.time()
+        found, val = self._fetch(key)
+        self._stats.timing(key, 'get', start_time)
+        self._stats.incr(key, 'hits' if found else 'misses')
+        callback(val if found else default)
+
+    def set(self, key, val, left_time=-1, callback=None, tags=None):
+        start_time = time.time()
+        if tags:
+            val = _Tagged(val, self._tag_gens(tags))
+        ret = self._set(key, val, self._expire_time(left_time))
+        self._stats.timing(key, 'set', start_time)
+        self._stats.incr(key, 'sets')
+        if callback:
+            callback(ret)
+
+    def invalidate_tag(self, tag, callback=None):
+        found, generation = self._get(tag_key(tag))
+        generation = max(generation + 1 if found else 0, int(time.time() * 1000))
+        ret = self._set(tag_key(tag), generation, 0)
+        if callback:
+            callback(ret)
+
+    def remove(self, key, callback=None):
+        ret = self._remove(key)
+        self._stats.incr(key, 'removes')
+        if callback:
+            callback(ret)
+
+    def get_many(self, keys, callback=None):
+        data = {}
+        for key in keys:
+            found, val = self._fetch(key)
+            self._stats.incr(key, 'hits' if found else 'misses')
+            if found:
+                data[key] = val
+        callback(data)
+
+    def set_many(self, mapping, left_time=-1, callback=None, tags=None):
+        expire_time = self._expire_time(left_time)
+        tag_gens = self._tag_gens(tags) if tags else None
+        count = 0
+        for key, val in mapping.items():
+            if tag_gens:
+                val = _Tagged(val, tag_gens)
+            self._stats.incr(key, 'sets')
+            if self._set(key, val, expire_time):
+                count += 1
+        if callback:
+            callback(count)
+
+    def delete_many(self, keys, callback=None):
+        count = 0
+        for key in keys:
+            self._stats.incr(key, 'removes')
+            if self._remove(key):
+                count += 1
+        if callback:
+            callback(count)
+
+
+class InProcess(_Local):
+    '''
+    进程内缓存
+    ============================
+
+    适用于单进程部署和测试, 超过 `max_size` 时淘汰最久未使用的缓存。
+
+    ``` python
+
+    'cache': {
+        'storage': 'InProcess',
+        'config': {'max_size': 10000},
+    }
+
+    ```
+    '''
+
+    def __init__(self, max_size=10000, **kwargs):
+        Base.__init__(self, kwargs.get('stats', True))
+        self._data = _LRU(max_size)
+
+    def _get(self, key):
+        item = self._data.get(key)
+        if not item:
+            return False, None
+        expire_time, val = item
+        if expire_time and expire_time < time.time():
+            self._stats.incr(key, 'expired')
+            self._data.pop(key)
+            return False, None
+        return True, copy.deepcopy(val)
+
+    def _set(self, key, val, expire_time):
+        self._data.put(key, (expire_time, copy.deepcopy(val)))
+        return True
+
+    def _remove(self, key):
+        return self._data.pop(key) is not None
+
+
+class SharedMemory(_Local):
+    '''
+    本机共享内存缓存
+    ============================
+
+    基于 mmap 文件的定长哈希表, 同一台机器上 fork 出来的多个进程(或打开同一
+    `path` 的进程)共享同一份数据, 省去网络往返。
+
+     - 表共有 `slots` 个槽, 每个槽 `slot_size` 字节, 值 pickle 后超过槽大小的不缓存
+     - key 落在连续的 `probe` 个槽内, 槽满时淘汰其中最早过期的一个
+     - 进程间用 fcntl 记录锁锁住对应的槽区间
+     - 文件头记录 `slots` 和 `slot_size`, 与配置不一致时重建文件
+       (`recreate` 为 False 时抛出 `Error`)
+
+    ``` python
+
+    'cache': {
+        'storage': 'SharedMemory',
+        'config': {'name': 'myapp', 'slots': 65536, 'slot_size': 1024},
+    }
+
+    ```
+    '''
+
+    # 槽头: key 的哈希, 过期时间(0 为永久), 数据长度
+    _head = struct.Struct('<QdI')
+    # 文件头: 标识, 槽数, 槽大小
+    _file_head = struct.Struct('<8sII')
+    _magic = 'XCATSHM1'
+
+    def __init__(self, name='xcat', path=None, slots=65536, slot_size=1024,
+                 probe=8, recreate=True, **kwargs):
+        Base.__init__(self, kwargs.get('stats', True))
+        if not path:
+            path = utils.shm_path('xcat.cache.%s' % name)
+
+        self.path = path
+        self.slots = int(slots)
+        self.slot_size = int(slot_size)
+        self.probe = min(int(probe), self.slots)
+
+        size = self._offset(self.slots)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        # 检查文件头时锁住, 避免多个进程同时重建
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self._file_head.size, 0)
+        try:
+            layout = (self._magic, self.slots, self.slot_size)
+            file_size = os.fstat(self._fd).st_size
+            if file_size:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                head = os.read(self._fd, self._file_head.size)
+                if file_size == size and len(head) == self._file_head.size \
+                        and self._file_head.unpack(head) == layout:
+                    layout = None
+                elif not recreate:
+                    raise Error('%s does not match slots=%s slot_size=%s'
+                                % (path, self.slots, self.slot_size))
+
+            if layout:
+                # 新文件或布局不一致, 清空后重建
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, self._file_head.pack(*layout))
+        except Exception:
+            os.close(self._fd)
+            raise
+        else:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self._file_head.size, 0)
+        self._mm = mmap.mmap(self._fd, size)
+
+    def _offset(self, index):
+        # 第 index 个槽在文件中的偏移
+        return self._file_head.size + index * self.slot_size
+
+    def _hash(self, key):
+        key = utf8(key) if isinstance(key, unicode) else str(key)
+        h = struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+        # 0 表示空槽
+        return h or 1
+
+    def _lock(self, h, mode):
+        start = h % (self.slots - self.probe + 1)
+        fcntl.lockf(self._fd, mode, self.probe * self.slot_size,
+                    self._offset(start))
+        return start
+
+    def _unlock(self, start):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, self.probe * self.slot_size,
+                    self._offset(start))
+
+    def _find(self, key, h, start):
+        # 返回 key 所在的槽的偏移, 没有则返回 None
+        for i in xrange(self.probe):
+            offset = self._offset(start + i)
+            slot_hash, expire_time, length = self._head.unpack_from(self._mm, offset)
+            if slot_hash == h and length:
+                begin = offset + self._head.size
+                if pickle.loads(self._mm[begin:begin + length])[0] == key:
+                    return offset
+        return None
+
+    def _get(self, key):
+        h = self._hash(key)
+        start = self._lock(h, fcntl.LOCK_SH)
+        try:
+            offset = self._find(key, h, start)
+            if offset is None:
+                return False, None
+            slot_hash, expire_time, length = self._head.unpack_from(self._mm, offset)
+            if expire_time and expire_time < time.time():
+                self._stats.incr(key, 'expired')
+                return False, None
+            begin = offset + self._head.size
+            return True, pickle.loads(self._mm[begin:begin + length])[1]
+        finally:
+            self._unlock(start)
+
+    def _set(self, key, val, expire_time):
+        data = pickle.dumps((key, val), pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size - self._head.size:
+            return False
+
+        h = self._hash(key)
+        start = self._lock(h, fcntl.LOCK_EX)
+        try:
+            offset = self._find(key, h, start)
+            if offset is None:
+                # 找空槽或已过期的槽, 都没有则淘汰最早过期的
+                this_time = time.time()
+                victim = None
+                for i in xrange(self.probe):
+                    slot_offset = self._offset(start + i)
+                    slot_hash, slot_expire, length = self._head.unpack_from(self._mm, slot_offset)
+                    if not length or (slot_expire and slot_expire < this_time):
+                        offset = slot_offset
+                        break
+                    if slot_expire and (victim is None or slot_expire < victim[0]):
+                        victim = (slot_expire, slot_offset)
+                if offset is None:
+                    offset = victim[1] if victim else self._offset(start)
+
+            self._head.pack_into(self._mm, offset, h, expire_time, len(data))
+            begin = offset + self._head.size
+            self._mm[begin:begin + len(data)] = data
+            return True
+        finally:
+            self._unlock(start)
+
+    def _remove(self, key):
+        h = self._hash(key)
+        start = self._lock(h, fcntl.LOCK_EX)
+        try:
+            offset = self._find(key, h, start)
+            if offset is None:
+                return False
+            self._head.pack_into(self._mm, offset, 0, 0, 0)
+            return True
+        finally:
+            self._unlock(start)
+
 # 测试
 if __name__ == '__main__':
     from tornado.ioloop import IOLoop
@@ -13,6 +13,7 @@ __all__ = [
     'reset',
 ]
 
+import sys
 import functools
 from mopee import AsyncModel, CharField, TextField
 from utils import Json
@@ -28,6 +29,8 @@ _work_plugins = []
 _config = {}
 # 可用插件列表
 _list = {}
+# 已加载的插件 handlers 模块
+_handler_modules = set()
 
 # 缓放缓存的key
 _cache_key = '__app.plugins__'
@@ -51,12 +54,16 @@ def init(method):
 @gen.engine
 def reset(callback=None):
     # 重置插件
-    global _list , _config , _work_plugins
+    global _list , _config , _work_plugins, _handler_modules
 
     _work_plugins = []
     _config       = {}
     _list         = {}
 
+    handler_modules = set()
+    # 路由是否有变化
+    changed = False
+
     plugin_configs = yield gen.Task(_application.cache.get, _cache_key, [])
 
     for plugin_data in plugin_configs:
@@ -73,11 +80,14 @@ def reset(callback=None):
             # 绑定 header
             for v in plugin_data.get('handlers', []): #Json.decode(plugin_ar.handlers):
                 plugin_module = v.split('.handlers.')[0] + '.handlers'
+                handler_modules.add(plugin_module)
                 
-                if plugin_module not in sys.modules.keys() :
+                if plugin_module not in sys.modules:
                     import_object(str(plugin_module))
-                else:
-                    reload(import_object(str(plugin_module)))
+                    changed = True
+                elif _application.reload_module(import_object(str(plugin_module))):
+                    # 只重新加载有改动的模块
+                    changed = True
 
         binds = plugin_data.get('bind', {})
         for event in binds:
@@ -87,6 +97,15 @@ def reset(callback=None):
                 v['name'] = plugin_name
                 _list[event].append(v)
 
+    if _application:
+        # 已卸载的插件, 移除它的路由
+        for name in _handler_modules - handler_modules:
+            _application.discard_module(name)
+            changed = True
+        _handler_modules = handler_modules
+
+        if changed:
+            _application.refresh_routes()
 
     if callback:
         callback(True)
@@ -326,7 +345,11 @@ def install(plugin_name, config=None, callback=None):
     # 尝试自加加载 handlers.py
     try:
         handlers = import_object(plugin_name + '.handlers')
-        reload(handlers)
+        # 经 Route.reload 重新加载, 原位替换已注册的路由
+        if _application:
+            _application.reload_module(handlers, force=True)
+        else:
+            reload(handlers)
         for v in dir(handlers):
           
             if issubclass(getattr(handlers,v), RequestHandler) \
@@ -9,22 +9,179 @@ session
 '''
 
 __all__ = [
+    'Error',
     'Base',
     'Mongod',
+    'SharedMemory',
+    'Cookie',
+    'SessionDict',
+    'get_client',
+    'pool_stats',
+    'flush_writes',
+    'install_shutdown_handler',
 ]
 
+import os
 import uuid 
 import time
+import zlib
+import atexit
+import signal
+import datetime
+import hashlib
 import asyncmongo
+import config
+import cache
+import utils
 
+from bson.son import SON
 from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.log import app_log
+from tornado.web import create_signed_value, decode_signed_value
+from tornado.escape import json_encode, json_decode
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+# 进程内共享的 asyncmongo.Client, 按连接参数区分
+_clients = {}
+# 连接池统计
+_pool_stats = {
+    'lookups' : 0,
+    'created' : 0,
+}
+
+def get_client(**kwargs):
+    '''
+    取进程内共享的 asyncmongo.Client, 相同的连接参数只创建一次
+    '''
+    args = (
+        kwargs.get('pool_id', 'xcat.session.Mongod'),
+        kwargs.get('host', '127.0.0.1'),
+        kwargs.get('port', 27017),
+        kwargs.get('maxcached', 10),
+        kwargs.get('maxconnections', 50),
+        kwargs.get('dbname', 'session'),
+        kwargs.get('dbuser', None),
+        kwargs.get('dbpass', None),
+    )
+    _pool_stats['lookups'] += 1
+
+    if args not in _clients:
+        _pool_stats['created'] += 1
+        _clients[args] = asyncmongo.Client(
+            pool_id = args[0], 
+            host = args[1], 
+            port = args[2], 
+            maxcached = args[3], 
+            maxconnections = args[4], 
+            dbname = args[5],
+            dbuser = args[6],
+            dbpass = args[7]
+        )
+    return _clients[args]
+
+def pool_stats():
+    '''
+    连接池统计: 查找 / 创建 client 的次数, 以及各连接池的连接数
+    '''
+    pools = []
+    for args, client in _clients.items():
+        pool = getattr(client, '_pool', None)
+        pools.append({
+            'pool_id' : args[0],
+            'host' : '%s:%s' % (args[1], args[2]),
+            'dbname' : args[5],
+            'connections' : getattr(pool, '_connections', None),
+            'idle' : len(getattr(pool, '_idle_cache', None) or []),
+        })
+
+    ret = dict(_pool_stats)
+    ret['clients'] = len(_clients)
+    ret['pools'] = pools
+    return ret
+
+
+class SessionDict(dict):
+    '''
+    记录了改动过的 key 的 session 数据
+
+    只跟踪对 session 本身的赋值和删除, 修改嵌套的对象需要重新赋值
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(SessionDict, self).__init__(*args, **kwargs)
+        self.changed = set()
+
+    def __setitem__(self, key, value):
+        self.changed.add(key)
+        super(SessionDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.changed.add(key)
+        super(SessionDict, self).__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self.changed.add(key)
+        return super(SessionDict, self).pop(key, *args)
+
+    def popitem(self):
+        key, value = super(SessionDict, self).popitem()
+        self.changed.add(key)
+        return key, value
+
+    def clear(self):
+        self.changed.update(self.keys())
+        super(SessionDict, self).clear()
+
+    def changes(self):
+        '''
+        返回 (需要设置的 {key: value}, 需要删除的 [key])
+        '''
+        values = {}
+        removed = []
+        for key in self.changed:
+            if key in self:
+                values[key] = self[key]
+            else:
+                removed.append(key)
+        return values, removed
+
+    def reset_changes(self):
+        self.changed = set()
+
+    def __reduce__(self):
+        # pickle 时只保存数据, 改动记录不随之保存
+        return (SessionDict, (dict(self),))
 
 
 class Base(object):
     '''
     异步 session 基类
+
+    同一个实例(一次请求)只读取一次存储, 之后的 get / set / remove 都在内存中进行;
+    set / remove 的改动会合并, 在下一次 IOLoop 循环(或调用 `flush` 时)一次写入。
+
+    读取时如果距上次更新时间已超过 `touch_interval` 秒(默认为生存周期的一半),
+    延长有效期; 存储支持 `touch` 时只把 session id 加入批量更新队列, 读取本身不写存储。
     '''
 
+    # 数据是否存放在客户端(cookie)
+    client_side = False
 
     def __init__(self, session_id = False, **settings):
         if False == session_id:
@@ -33,47 +190,134 @@ class Base(object):
         self.settings = settings
         self.session_id = session_id
         self.left_time = int(settings.get('left_time', 1800))
+        self.touch_interval = int(settings.get('touch_interval', self.left_time / 2))
         self.storage = self.get_storage()
-        
+
+        # 已读取的数据
+        self._data = None
+        # 等待读取结果的回调
+        self._loading = []
+        # 等待写入结果的回调
+        self._pending = []
+        self._flush_scheduled = False
         
     @property
     def id(self):
         # 返回 session id
         return self.session_id
 
+    @property
+    def data(self):
+        # 已读取的数据, 未读取时为 None
+        return self._data
+
     def get_storage(self):
         pass
 
+    def create(self):
+        # 新 session, 不需要读取存储
+        self._data = SessionDict()
+        return self._data
+
+    @classmethod
+    def prepare(cls, **settings):
+        # 启动时(fork 之前)调用, 只做不建立连接的准备
+        pass
+
+    @classmethod
+    def warm_up(cls, **settings):
+        # fork 之后(收到第一个请求时)调用, 预先建立连接
+        pass
+
     def get_all(self, callback=None):
-        def _remove_callback(ret):
-            callback({})
+        if self._data is not None:
+            return callback(self._data)
 
-        def _update_callback(value):
-            data = value.get('data', {})
-            callback(data)
+        self._loading.append(callback)
+        if len(self._loading) > 1:
+            # 已经在读取中
+            return
+
+        def _loaded(data):
+            self._data = SessionDict(data)
+            callbacks, self._loading = self._loading, []
+            for cb in callbacks:
+                cb(self._data)
+
+        def _remove_callback(ret):
+            _loaded({})
 
         def _callback(value):
             if not value:
-                return callback({})
+                return _loaded({})
+
+            # cookie 存储读取时才能得到真实的 session id
+            self.session_id = value.get('session_id', self.session_id)
 
             this_time = int(time.time())
-            cache_life = value.get('time', 0) + self.left_time
-            if cache_life < this_time:
+            last_time = value.get('time', 0)
+            data = value.get('data', {})
+            if last_time + self.left_time < this_time:
                 # 缓存已经失效
-                self.clear(callback=_remove_callback)
-            elif (cache_life - this_time) > (self.left_time / 2):
-                # 缓存周期已经超过生存周期的一半，更新时间周期
-                self.storage.set(value.get('data', {}), callback=_update_callback)
-            else:
-                data = value.get('data', {})
-                callback(data)
+                return self.storage.remove(callback=_remove_callback)
+
+            if this_time - last_time >= self.touch_interval:
+                # 延长有效期, 不等待写入
+                if hasattr(self.storage, 'touch'):
+                    self.storage.touch()
+                else:
+                    self.storage.set(data)
+            _loaded(data)
 
         self.storage.get(callback=_callback)
 
+    def _schedule_flush(self, callback):
+        self._pending.append(callback)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            IOLoop.current().add_callback(self.flush)
+
+    def flush(self, callback=None):
+        '''
+        把合并的改动一次写入存储, 只写改动过的 key (存储支持时)
+        '''
+        self._flush_scheduled = False
+        callbacks, self._pending = self._pending, []
+        if callback:
+            callbacks.append(callback)
+
+        data = self._data
+        session_data = {
+            'session_id' : self.session_id,
+            'data' : data,
+            'time' : int(time.time()),
+        }
+
+        def _done(*args):
+            for cb in callbacks:
+                if cb:
+                    cb(session_data)
+
+        if data is None or not data.changed:
+            return _done()
+
+        values, removed = data.changes()
+        data.reset_changes()
+
+        if not data:
+            return self.storage.remove(callback=_done)
+
+        if hasattr(self.storage, 'update'):
+            try:
+                return self.storage.update(values, removed, callback=_done)
+            except Error:
+                pass
+        self.storage.set(dict(data), callback=_done)
+
     def set(self, key, value, callback=None):
         def _callback(data):
             data[key] = value
-            self.storage.set(data, callback)
+            self._schedule_flush(callback)
 
         self.get_all(_callback)
 
@@ -89,10 +333,8 @@ class Base(object):
 
     def remove(self, key, callback=None):
         def _set_callback(data):
-            if data:
+            if callback:
                 callback(True)
-            else:
-                callback(False)
 
         def _callback(data):
             if not data:
@@ -100,32 +342,415 @@ class Base(object):
 
             if data.has_key(key):
                 del data[key]
-                self.storage.set(data, _set_callback)
+                self._schedule_flush(_set_callback)
             else:
                 callback(False)
 
         self.get_all(callback=_callback)
 
     def clear(self, callback=None):
+        # 原地清空, handler 持有的仍是同一份数据, finish 时不会把旧数据写回
+        if self._data is None:
+            self._data = SessionDict()
+        else:
+            self._data.clear()
+            self._data.reset_changes()
         self.storage.remove(callback)
 
+class Error(Exception):
+    pass
+
+# 已建过索引的 (dbname, table)
+_indexed = set()
+
+def _expire_at(this_time, left_time):
+    '''
+    过期时间, 用 datetime 存放, 供 TTL 索引使用
+    '''
+    return datetime.datetime.utcfromtimestamp(this_time + left_time)
+
+def _ensure_indexes(conn, dbname, table, left_time):
+    if (dbname, table) in _indexed:
+        return
+    _indexed.add((dbname, table))
+    _backfill(conn, table, left_time)
+
+    utils.Mongo.ensure_index(conn, dbname, table, 'session_id',
+                             unique=True, dropDups=True)
+    # TTL 索引: mongod 后台按 expire_at 删除过期的 session,
+    # 没人再访问的 session 也会被清理
+    utils.Mongo.ensure_index(conn, dbname, table, 'expire_at', expireAfterSeconds=0)
+
+# 每批补齐的 session 数
+backfill_chunk = 500
+
+def _backfill(conn, table, left_time):
+    # 给旧版本写入的 session 补上 expire_at (time + left_time), 否则 TTL 索引不会清理
+    def _update(doc):
+        return {'$set' : {'expire_at' : _expire_at(int(doc.get('time', 0)), left_time)}}
+
+    utils.Mongo.backfill(conn, table, {'expire_at' : {'$exists' : False}},
+                         {'time' : 1}, _update, backfill_chunk)
+
+class _TouchQueue(object):
+    '''
+    批量延长 session 有效期: 收集 session id, 定时用一次 update 只更新 time
+    '''
+
+    # 每次 update 最多包含的 session id 数
+    chunk_size = 1000
+
+    def __init__(self, conn, table, left_time, interval=1, safe=True):
+        self._conn = conn
+        self._table = table
+        self.left_time = left_time
+        self.interval = interval
+        self.safe = safe
+        self._ids = set()
+        self._timer = None
+
+    def add(self, session_id):
+        self._ids.add(session_id)
+        if not self._timer:
+            self._timer = PeriodicCallback(self.flush, int(self.interval * 1000))
+            self._timer.start()
+
+    def flush(self):
+        if not self._ids:
+            return
+
+        ids, self._ids = list(self._ids), set()
+        table = self._conn[self._table]
+        this_time = int(time.time())
+        options = self.safe if isinstance(self.safe, dict) else {}
+
+        def _callback(*args, **kwargs):
+            pass
+
+        for i in xrange(0, len(ids), self.chunk_size):
+            where = {'session_id' : {'$in' : ids[i:i + self.chunk_size]}}
+            document = {'$set' : {
+                'time' : this_time,
+                'expire_at' : _expire_at(this_time, self.left_time),
+            }}
+            if self.safe:
+                table.update(where, document, multi=True, safe=True,
+                             callback=_callback, **options)
+            else:
+                table.update(where, document, multi=True, safe=False)
+
+# 按 (dbname, table) 共享的 touch 队列
+_touch_queues = {}
+
+def _touch_queue(conn, dbname, table, settings):
+    key = (dbname, table)
+    if key not in _touch_queues:
+        _touch_queues[key] = _TouchQueue(conn, table,
+                                         int(settings.get('left_time', 1800)),
+                                         settings.get('touch_flush_interval', 1),
+                                         settings.get('safe', True))
+    return _touch_queues[key]
+
+class _WriteQueue(object):
+    '''
+    延迟批量写入 session: 同一个 session 的多次写入在内存中合并,
+    每 `interval` 秒或积压超过 `max_size` 个 session 时,
+    用一条 update 命令和一条 delete 命令提交 (需要 mongod 2.6+)
+    '''
+
+    # 每条命令最多包含的 session 数
+    chunk_size = 1000
+
+    def __init__(self, conn, table, left_time, interval=1, max_size=1000, safe=True):
+        self._conn = conn
+        self._table = table
+        self.left_time = left_time
+        self.interval = interval
+        self.max_size = max_size
+        self.safe = safe
+        # session_id -> 合并后的改动
+        self._entries = {}
+        # 正在提交的改动, 提交完成前读取也要合并
+        self._flushing = None
+        # 等待提交完成的回调
+        self._waiting = []
+        self._timer = None
+
+    def _add(self, session_id, entry):
+        self._entries[session_id] = entry
+        if not self._timer:
+            self._timer = PeriodicCallback(self.flush, int(self.interval * 1000))
+            self._timer.start()
+        if len(self._entries) >= self.max_size:
+            self.flush()
+
+    def set(self, session_id, data):
+        self._add(session_id, {'data' : dict(data)})
+
+    def update(self, session_id, values, removed):
+        entry = self._entries.get(session_id) or {'set' : {}, 'unset' : set()}
+        if entry.get('remove'):
+            # 删除后再写入, 等同于只含这些 key 的新 session
+            entry = {'data' : {}}
+
+        if 'data' in entry:
+            entry['data'].update(values)
+            for key in removed:
+                entry['data'].pop(key, None)
+        else:
+            entry['set'].update(values)
+            entry['unset'].difference_update(values.keys())
+            for key in removed:
+                entry['set'].pop(key, None)
+                entry['unset'].add(key)
+        self._add(session_id, entry)
+
+    def remove(self, session_id):
+        self._add(session_id, {'remove' : True})
+
+    def apply(self, session_id, value):
+        '''
+        把尚未写入的改动合并到从数据库读出的 session 上
+        '''
+        for entries in (self._flushing, self._entries):
+            entry = entries and entries.get(session_id)
+            if not entry:
+                continue
+            if entry.get('remove'):
+                value = None
+                continue
+
+            this_time = int(time.time())
+            if 'data' in entry:
+                data = dict(entry['data'])
+            else:
+                data = dict(value.get('data', {})) if value else {}
+                data.update(entry['set'])
+                for key in entry['unset']:
+                    data.pop(key, None)
+            value = {
+                'session_id' : session_id,
+                'data' : data,
+                'time' : this_time,
+            }
+        return value
+
+    def _command(self, command, callback):
+        if not self.safe:
+            command['writeConcern'] = {'w' : 0}
+        elif isinstance(self.safe, dict):
+            command['writeConcern'] = self.safe
+
+        def _callback(data, error):
+            # 提交失败的 session 改动已丢失, 记录下来
+            if error:
+                app_log.error('write-behind %s on %s failed: %s',
+                              command.keys()[0], self._table, error)
+            elif not data.get('ok'):
+                app_log.error('write-behind %s on %s failed: %s',
+                              command.keys()[0], self._table, data.get('errmsg', data))
+            callback()
+
+        # 命令总会有响应, 不确认时也等待响应, 保证已经发出
+        self._conn['$cmd'].find_one(command, callback=_callback)
+
+    def flush(self, callback=None):
+        if callback:
+            self._waiting.append(callback)
+        if self._flushing is not None:
+            # 上一批提交完成后再提交, 保证同一 session 的写入顺序
+            return
+
+        if not self._entries:
+            callbacks, self._waiting = self._waiting, []
+            for cb in callbacks:
+                cb()
+            return
+
+        entries, self._entries = self._entries, {}
+        self._flushing = entries
+
+        this_time = int(time.time())
+        expire_at = _expire_at(this_time, self.left_time)
+        updates = []
+        removes = []
+        for session_id, entry in entries.items():
+            if entry.get('remove'):
+                removes.append(session_id)
+                continue
+
+            if 'data' in entry:
+                document = {
+                    'session_id' : session_id,
+                    'data' : entry['data'],
+                    'time' : this_time,
+                    'expire_at' : expire_at,
+                }
+            else:
+                document = {'$set' : {
+                    'time' : this_time,
+                    'expire_at' : expire_at,
+                }}
+                for key, value in entry['set'].items():
+                    document['$set']['data.%s' % key] = value
+                if entry['unset']:
+                    document['$unset'] = dict([('data.%s' % key, 1) for key in entry['unset']])
+            updates.append({
+                'q' : {'session_id' : session_id},
+                'u' : document,
+                'upsert' : True,
+            })
+
+        commands = []
+        for i in xrange(0, len(updates), self.chunk_size):
+            commands.append(SON([
+                ('update', self._table),
+                ('updates', updates[i:i + self.chunk_size]),
+                ('ordered', False),
+            ]))
+        for i in xrange(0, len(removes), self.chunk_size):
+            commands.append(SON([
+                ('delete', self._table),
+                ('deletes', [{
+                    'q' : {'session_id' : {'$in' : removes[i:i + self.chunk_size]}},
+                    'limit' : 0,
+                }]),
+                ('ordered', False),
+            ]))
+
+        state = {'count' : len(commands)}
+
+        def _done():
+            state['count'] -= 1
+            if state['count']:
+                return
+            self._flushing = None
+            if self._waiting:
+                # 有回调在等待, 把提交期间积压的改动也提交
+                self.flush()
+
+        for command in commands:
+            self._command(command, _done)
+
+# 按 (dbname, table) 共享的延迟写入队列
+_write_queues = {}
+
+def _write_queue(conn, dbname, table, settings):
+    key = (dbname, table)
+    if key not in _write_queues:
+        _write_queues[key] = _WriteQueue(conn, table,
+                                         int(settings.get('left_time', 1800)),
+                                         settings['write_behind'],
+                                         int(settings.get('write_behind_size', 1000)),
+                                         settings.get('safe', True))
+    return _write_queues[key]
+
+def flush_writes(callback=None):
+    '''
+    立即提交所有延迟写入的 session, 全部完成后回调
+    '''
+    queues = _write_queues.values()
+    state = {'count' : len(queues)}
+
+    def _done():
+        state['count'] -= 1
+        if state['count'] <= 0 and callback:
+            callback()
+
+    if not queues:
+        return _done()
+
+    for queue in queues:
+        queue.flush(_done)
+
+def install_shutdown_handler(timeout=5):
+    '''
+    收到 SIGTERM / SIGINT 时先提交延迟写入的 session, 再停止 IOLoop
+    (最多等待 `timeout` 秒)。atexit 在 SIGTERM 时不会执行, 使用 `write_behind`
+    时应在 fork 之后、启动 IOLoop 之前调用:
+
+    ``` python
+
+    server.start(0)
+    session.install_shutdown_handler()
+    IOLoop.instance().start()
+
+    ```
+    '''
+    io_loop = IOLoop.instance()
+
+    def _shutdown():
+        io_loop.add_timeout(time.time() + timeout, io_loop.stop)
+        flush_writes(io_loop.stop)
+
+    def _handler(signum, frame):
+        io_loop.add_callback_from_signal(_shutdown)
+
+    signal.signal(signal.SIGTERM, _handler)
+    signal.signal(signal.SIGINT, _handler)
+
+@atexit.register
+def _flush_writes_at_exit():
+    # 正常退出时提交剩余的延迟写入
+    if not any([queue._entries or queue._flushing for queue in _write_queues.values()]):
+        return
+
+    def _flush():
+        future = Future()
+        flush_writes(lambda: future.set_result(None))
+        return future
+
+    try:
+        IOLoop.current().run_sync(_flush, timeout=5)
+    except Exception:
+        pending = sum([len(queue._entries) for queue in _write_queues.values()])
+        app_log.error('flush %d write-behind sessions at exit failed', pending,
+                      exc_info=True)
+
 class Mongod(Base):
-    """"基于Mongod的session"""
+    """"基于Mongod的session
+
+    配置 `safe` 为 False 时写入不等待 getLastError 确认, 发出即回调;
+    也可以是 getLastError 的参数, 如 `{'w': 2}`。
+
+    配置 `write_behind` (秒) 时写入先在内存中按 session 合并, 定时或积压超过
+    `write_behind_size` 个 session 时批量提交 (需要 mongod 2.6+), 写入立即回调。
+    正常退出时(atexit)提交剩余的写入; atexit 在 SIGTERM 时不会执行, 需调用
+    `install_shutdown_handler` 或在自己的关闭流程中调用 `flush_writes`。
+    提交失败时记录日志。
+
+    旧版本写入的 session 没有 `expire_at`, 首次建索引时在后台按 `time + left_time` 补上
+    (需要 mongod 2.6+)。
+    """
 
     class Storage(object):
 
-        def __init__(self, conn, table, session_id, left_time):
+        def __init__(self, conn, table, session_id, left_time, safe=True,
+                     touch_queue=None, write_queue=None):
             self._conn = conn
             self._table = self._conn[table]
             self.session_id = session_id
             self.left_time = left_time
+            self.safe = safe
+            self.touch_queue = touch_queue
+            self.write_queue = write_queue
             self.where = {'session_id': session_id}
 
+        def touch(self):
+            # 加入批量更新队列, 稍后只更新 time
+            self.touch_queue.add(self.session_id)
+
+        def _write(self, op, *args, **kwargs):
+            # 按 session 配置的 safe 写入
+            utils.Mongo.write(self._table, self.safe, op, *args, **kwargs)
+
         def get(self, callback=None):
             def _callback(value, error):
                 if callback:
                     if error:
                         raise Error(error)
+                    if self.write_queue:
+                        value = self.write_queue.apply(self.session_id, value)
                     if value:
                         callback(value)
                     else:
@@ -134,6 +759,12 @@ class Mongod(Base):
             self._table.find_one(self.where, callback=_callback)   
 
         def remove(self, callback=None):
+            if self.write_queue:
+                self.write_queue.remove(self.session_id)
+                if callback:
+                    callback(True)
+                return
+
             def _callback(data, error):
                 if callback:
                     if error:
@@ -142,17 +773,24 @@ class Mongod(Base):
                     if callback:
                         callback(len(data) == 1)
 
-            self._table.remove(self.where, callback=_callback)
+            self._write('remove', self.where, callback=_callback)
 
 
-        @gen.engine
         def set(self, value, callback=None):
+            this_time = int(time.time())
             session_data = {
                 'session_id' : self.session_id,
                 'data' : value,
-                'time' : int(time.time())
+                'time' : this_time,
+                'expire_at' : _expire_at(this_time, self.left_time),
             }
 
+            if self.write_queue:
+                self.write_queue.set(self.session_id, value)
+                if callback:
+                    callback(session_data)
+                return
+
             def _callback(data, error):
                 if callback:
                     if error:
@@ -161,33 +799,378 @@ class Mongod(Base):
                     if callback:
                         callback(session_data)
 
-            ret, error = yield gen.Task(self._table.find_one, self.where)
-            data = ret[0]
-            
-            if not data or len(data) == 0:
-                self._table.insert(session_data, callback=_callback)
-            else:
-                self._table.update({
-                    '_id' : data['_id']
-                }, session_data, upsert=True, safe=True, callback=_callback)
-                
+            # 以 session_id 为条件 upsert, 一次往返
+            self._write('update', self.where, session_data, upsert=True, callback=_callback)
+
+        def update(self, values, removed, callback=None):
+            '''
+            只写入改动过的 key: values 用 $set, removed 用 $unset
+            '''
+            for key in values.keys() + removed:
+                if not isinstance(key, basestring) or '.' in key or key.startswith('$'):
+                    # 不能作为字段路径的 key, 只能整体写入
+                    raise Error('session key %r can not be updated partially' % key)
+
+            if self.write_queue:
+                self.write_queue.update(self.session_id, values, removed)
+                if callback:
+                    callback(True)
+                return
+
+            this_time = int(time.time())
+            document = {'$set' : {
+                'time' : this_time,
+                'expire_at' : _expire_at(this_time, self.left_time),
+            }}
+            for key, value in values.items():
+                document['$set']['data.%s' % key] = value
+            if removed:
+                document['$unset'] = dict([('data.%s' % key, 1) for key in removed])
+
+            def _callback(data, error):
+                if callback:
+                    if error:
+                        raise Error(error)
+
+                    callback(len(data) == 1)
+
+            self._write('update', self.where, document, upsert=True, callback=_callback)
+
+
+    @classmethod
+    def warm_up(cls, **settings):
+        '''
+        创建共享的 client, 并发出 `warm_connections` 个查询, 预先建立连接
+        '''
+        conn = get_client(**settings)
+        _ensure_indexes(conn, settings.get('dbname', 'session'),
+                        settings.get('table', 'sessions'),
+                        int(settings.get('left_time', 1800)))
+        table = conn[settings.get('table', 'sessions')]
+
+        def _callback(*args, **kwargs):
+            pass
+
+        for i in range(int(settings.get('warm_connections', 1))):
+            table.find_one({'session_id' : None}, callback=_callback)
+
     def get_storage(self):
         kwargs = self.settings
-        conn = asyncmongo.Client(
-            pool_id = kwargs.get('pool_id', 'xcat.session.Mongod'), 
-            host = kwargs.get('host', '127.0.0.1'), 
-            port = kwargs.get('port', 27017), 
-            maxcached = kwargs.get('maxcached', 10), 
-            maxconnections = kwargs.get('maxconnections', 50), 
-            dbname = kwargs.get('dbname', 'session'),
-            dbuser = kwargs.get('dbuser', None),
-            dbpass = kwargs.get('dbpass', None)
-        )
+        conn = get_client(**kwargs)
 
         table = kwargs.get('table', 'sessions')
+        dbname = kwargs.get('dbname', 'session')
+        _ensure_indexes(conn, dbname, table, self.left_time)
+
+        write_queue = None
+        if kwargs.get('write_behind'):
+            write_queue = _write_queue(conn, dbname, table, kwargs)
 
-        return self.Storage(conn, table, self.session_id, self.left_time)
+        return self.Storage(conn, table, self.session_id, self.left_time,
+                            kwargs.get('safe', True),
+                            _touch_queue(conn, dbname, table, kwargs),
+                            write_queue)
         
+# 按 (name, path) 共享的共享内存表, fork 前打开时子进程直接沿用
+_shm_tables = {}
+
+def _shm_table(settings):
+    key = (settings.get('name', 'xcat'), settings.get('path'))
+    if key not in _shm_tables:
+        path = key[1]
+        if not path:
+            # 与 cache.SharedMemory 的默认文件分开
+            path = utils.shm_path('xcat.session.%s' % key[0])
+        try:
+            # 文件布局与配置不一致时不重建, 避免清掉其它进程正在使用的 session
+            _shm_tables[key] = cache.SharedMemory(key[0], path,
+                                                  settings.get('slots', 65536),
+                                                  settings.get('slot_size', 4096),
+                                                  settings.get('probe', 8),
+                                                  recreate=False,
+                                                  stats=False)
+        except cache.Error, e:
+            raise Error(str(e))
+    return _shm_tables[key]
+
+class SharedMemory(Base):
+    '''
+    本机共享内存 session
+    ============================
+
+    session 存放在 `cache.SharedMemory` 的 mmap 哈希表中, 同一台机器上的多个
+    进程共享, 读写不经过网络。配置 `write_through` 时同时写入该存储
+    (如 `Mongod`), 本机表中没有(重启或被淘汰)时从中读回, 保证数据不丢失。
+
+    序列化后超过 `slot_size` 的 session 只写入 `write_through` 存储,
+    没有配置 `write_through` 时抛出 `Error`。
+
+    默认文件为 `/dev/shm/xcat.session.<name>`, 与缓存的文件分开; 已有文件的
+    `slots` / `slot_size` 与配置不一致时抛出 `Error`, 需要先删除旧文件。
+
+    ``` python
+
+    'session': {
+        'storage': 'SharedMemory',
+        'config': {
+            'left_time': 1800,
+            'name': 'myapp',
+            'slots': 65536,
+            'slot_size': 4096,
+            'write_through': 'Mongod',
+            'write_through_config': {},
+        },
+    }
+
+    ```
+    '''
+
+    class Storage(object):
+
+        def __init__(self, table, session_id, left_time, durable=None):
+            self._table = table
+            self.session_id = session_id
+            self.left_time = left_time
+            self.durable = durable
+            self.key = 'session:%s' % session_id
+
+        def _put(self, session_data):
+            return self._table._set(self.key, session_data,
+                                    session_data['time'] + self.left_time)
+
+        def get(self, callback=None):
+            found, value = self._table._get(self.key)
+            if found or not self.durable:
+                return callback(value)
+
+            def _callback(value):
+                if value:
+                    self._put({
+                        'session_id' : self.session_id,
+                        'data' : value.get('data', {}),
+                        'time' : value.get('time', 0),
+                    })
+                callback(value)
+
+            self.durable.get(callback=_callback)
+
+        def set(self, value, callback=None):
+            session_data = {
+                'session_id' : self.session_id,
+                'data' : value,
+                'time' : int(time.time())
+            }
+
+            if not self._put(session_data):
+                # 放不进槽, 删除旧值, 只留在持久存储中
+                self._table._remove(self.key)
+                if not self.durable:
+                    raise Error('session %s is too large for shared memory' % self.session_id)
+
+            if self.durable:
+                return self.durable.set(value, callback=callback)
+
+            if callback:
+                callback(session_data)
+
+        def touch(self):
+            found, value = self._table._get(self.key)
+            if found:
+                value['time'] = int(time.time())
+                self._put(value)
+
+            if self.durable:
+                if hasattr(self.durable, 'touch'):
+                    self.durable.touch()
+                elif found:
+                    self.durable.set(value['data'])
+
+        def remove(self, callback=None):
+            ret = self._table._remove(self.key)
+            if self.durable:
+                return self.durable.remove(callback=callback)
+
+            if callback:
+                callback(ret)
+
+    @classmethod
+    def prepare(cls, **settings):
+        '''
+        在 fork 之前打开共享内存表, 子进程共用
+        '''
+        _shm_table(settings)
+
+    @classmethod
+    def warm_up(cls, **settings):
+        '''
+        预热 `write_through` 存储的连接
+        '''
+        if settings.get('write_through'):
+            Session = globals()[settings['write_through']]
+            Session.warm_up(**settings.get('write_through_config', {}))
+
+    def get_storage(self):
+        durable = None
+        if self.settings.get('write_through'):
+            Session = globals()[self.settings['write_through']]
+            durable_config = dict(self.settings.get('write_through_config', {}))
+            durable_config['left_time'] = self.left_time
+            durable = Session(self.session_id, **durable_config).storage
+
+        return self.Storage(_shm_table(self.settings), self.session_id,
+                            self.left_time, durable)
+
+class Cookie(Base):
+    '''
+    基于签名 cookie 的客户端 session
+    ============================
+
+    session 数据直接存放在 cookie 中, 用 `config` 中的 `cookie_secret` 签名,
+    读写都没有存储往返。可选压缩(`compress`)和加密(`encrypt`, 需要 pycrypto)。
+    签名后超过 `max_size` 字节时, 数据改存到 `fallback` 指定的服务端存储,
+    cookie 中只保留 session id。
+
+    数据以 json 序列化, 只能存放 json 可表示的值。
+
+    ``` python
+
+    'session': {
+        'storage': 'Cookie',
+        'config': {
+            'left_time': 1800,
+            'compress': True,
+            'encrypt': False,
+            'max_size': 3800,
+            'fallback': 'Mongod',
+            'fallback_config': {},
+        },
+    }
+
+    ```
+    '''
+
+    client_side = True
+
+    class Storage(object):
+
+        def __init__(self, handler, name, session_id, left_time, **settings):
+            self.handler = handler
+            self.name = name
+            self.session_id = session_id
+            self.left_time = left_time
+            self.secret = settings.get('secret') or config.get('cookie_secret')
+            self.compress = settings.get('compress', True)
+            self.encrypt = settings.get('encrypt', False)
+            self.max_size = int(settings.get('max_size', 3800))
+            self.fallback = settings.get('fallback', 'Mongod')
+            self.fallback_config = settings.get('fallback_config', {})
+            self._fallback_storage = None
+
+            if self.encrypt and not AES:
+                raise Error('pycrypto is required to encrypt session cookies')
+
+        def _key(self):
+            return hashlib.sha256(self.secret).digest()
+
+        def _encode(self, payload):
+            flags = ''
+            data = json_encode(payload)
+            if self.compress:
+                data = zlib.compress(data)
+                flags += 'z'
+            if self.encrypt:
+                iv = os.urandom(16)
+                data = iv + AES.new(self._key(), AES.MODE_CFB, iv).encrypt(data)
+                flags += 'e'
+            return create_signed_value(self.secret, self.name, flags + '|' + data)
+
+        def _decode(self, value):
+            max_age_days = max(self.left_time / 86400.0, 1)
+            data = decode_signed_value(self.secret, self.name, value, max_age_days)
+            if not data or '|' not in data:
+                return None
+
+            flags, data = data.split('|', 1)
+            try:
+                if 'e' in flags:
+                    if not AES:
+                        return None
+                    data = AES.new(self._key(), AES.MODE_CFB, data[:16]).decrypt(data[16:])
+                if 'z' in flags:
+                    data = zlib.decompress(data)
+                return json_decode(data)
+            except Exception:
+                return None
+
+        def _write_cookie(self, cookie):
+            self.handler.set_cookie(self.name, cookie,
+                                    expires=time.time() + self.left_time)
+
+        def fallback_storage(self):
+            # 数据过大时使用的服务端存储
+            if not self._fallback_storage:
+                Session = globals()[self.fallback]
+                settings = dict(self.fallback_config)
+                settings.setdefault('left_time', self.left_time)
+                self._fallback_storage = Session(self.session_id, **settings).storage
+            return self._fallback_storage
+
+        def get(self, callback=None):
+            value = self.handler.get_cookie(self.name)
+            payload = self._decode(value) if value else None
+            if not payload:
+                return callback(None)
+
+            self.session_id = payload.get('id', self.session_id)
+            if payload.get('fallback'):
+                return self.fallback_storage().get(callback=callback)
+
+            callback({
+                'session_id' : self.session_id,
+                'data' : payload.get('data', {}),
+                'time' : payload.get('time', 0),
+            })
+
+        def set(self, value, callback=None):
+            session_data = {
+                'session_id' : self.session_id,
+                'data' : value,
+                'time' : int(time.time())
+            }
+
+            cookie = self._encode({
+                'id' : self.session_id,
+                'data' : value,
+                'time' : session_data['time'],
+            })
+            if len(cookie) <= self.max_size:
+                self._write_cookie(cookie)
+                if callback:
+                    callback(session_data)
+                return
+
+            # 超过 cookie 大小限制, 存到服务端
+            self._write_cookie(self._encode({'id' : self.session_id, 'fallback' : True}))
+            self.fallback_storage().set(value, callback=callback)
+
+        def remove(self, callback=None):
+            value = self.handler.get_cookie(self.name)
+            payload = self._decode(value) if value else None
+            self.handler.clear_cookie(self.name)
+
+            if payload and payload.get('fallback'):
+                return self.fallback_storage().remove(callback=callback)
+
+            if callback:
+                callback(True)
+
+    def get_storage(self):
+        kwargs = dict(self.settings)
+        handler = kwargs.pop('handler')
+        name = kwargs.pop('name', 'PYSESSID')
+        kwargs.pop('left_time', None)
+        return self.Storage(handler, name, self.session_id, self.left_time, **kwargs)
+
 '''
 测试 and 用法
 '''
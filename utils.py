@@ -11,16 +11,24 @@ __all__ = [
     'Date',
     'Filters',
     'Validators',
+    'Mongo',
+    'shm_path',
 ]
 
 
+import os
 import types
 import re
 import time
 import hashlib
 import sys
+import tempfile
 from HTMLParser import HTMLParser
+from bson.son import SON
 from tornado import escape
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
 
 
 def md5(s):
@@ -231,3 +239,89 @@ class Validators:
             return True
         return False
 
+
+def shm_path(filename):
+    '''
+    共享内存文件的路径, 没有 /dev/shm 时放在临时目录
+    '''
+    path = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(path, filename)
+
+class Mongo:
+    '''
+    asyncmongo 辅助方法
+    =============
+
+    #### 方法:
+
+     - ensure_index 建索引
+     - write 按写确认模式写入
+     - backfill 后台分批更新旧版本写入的记录
+
+    '''
+
+    @staticmethod
+    def ensure_index(conn, dbname, table, field, **options):
+        # asyncmongo 没有 ensure_index, 直接写 system.indexes
+        index = {
+            'ns' : '%s.%s' % (dbname, table),
+            'key' : {field : 1},
+            'name' : '%s_1' % field,
+        }
+        index.update(options)
+        conn['system.indexes'].insert(index, safe=False)
+
+    @staticmethod
+    def write(table, safe, op, *args, **kwargs):
+        '''
+        `safe` 为 False 时不等待 getLastError, 直接回调;
+        也可以是 getLastError 的参数, 如 `{'w': 2}`
+        '''
+        callback = kwargs.pop('callback', None)
+        if not safe:
+            getattr(table, op)(*args, safe=False, **kwargs)
+            if callback:
+                callback([{}], None)
+            return
+
+        if isinstance(safe, dict):
+            kwargs.update(safe)
+        getattr(table, op)(*args, safe=True, callback=callback, **kwargs)
+
+    @staticmethod
+    @gen.engine
+    def backfill(conn, table, where, fields, update, chunk_size=500):
+        '''
+        每次取出 `chunk_size` 条符合 `where` 的记录, 用 `update(doc)` 生成的 modifier
+        以 update 命令(需要 mongod 2.6+)批量写入, 批与批之间让出 IOLoop。
+        `update` 写入后记录应不再符合 `where`; 出错时记录日志并停止, 不会重复处理同一批记录
+        '''
+        while True:
+            ret, error = yield gen.Task(conn[table].find, where,
+                                        fields=fields, limit=chunk_size)
+            docs = ret[0]
+            if error.get('error'):
+                app_log.error('backfill %s failed: %s', table, error)
+                break
+            if not docs:
+                break
+
+            updates = []
+            for doc in docs:
+                q = dict(where)
+                q['_id'] = doc['_id']
+                updates.append({'q' : q, 'u' : update(doc)})
+
+            ret, error = yield gen.Task(conn['$cmd'].find_one, SON([
+                ('update', table),
+                ('updates', updates),
+                ('ordered', False),
+            ]))
+            if error.get('error') or not ret[0] or not ret[0].get('ok') \
+                    or ret[0].get('writeErrors'):
+                app_log.error('backfill %s failed: %s', table,
+                              error.get('error') or ret[0])
+                break
+
+            # 让出 IOLoop, 不阻塞正常请求
+            yield gen.Task(IOLoop.instance().add_callback)
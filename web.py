@@ -9,10 +9,10 @@ __all__ = [
     'acl',
     'route',
     'session',
+    'load_session',
     'Application',
     'RequestHandler'
 ]
-import copy
 import time
 import functools
 import session as Xsession
@@ -29,6 +29,8 @@ from tornado.web import url, RequestHandler, \
      StaticFileHandler, Application, asynchronous
 from tornado.escape import linkify
 from tornado import gen
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.concurrent import Future
 from tornado.options import options, define
 from tornado.util import import_object
 from jinja2 import Environment, FileSystemLoader
@@ -58,62 +60,178 @@ def form(form_name):
 
     return load
 
+def _save_session(self):
+    if not hasattr(self, 'session'):
+        # 懒加载且未使用过 session
+        return
+
+    # 是否等待写入确认由 session 配置的 safe 决定
+    if self.session is self._session.data:
+        # 只写改动过的 key
+        return self._session.flush()
+
+    # session 被整体替换过
+    if self.session:
+        #print 'save session'
+        self._session.storage.set(dict(self.session))
+    else:
+        #print 'clear session'
+        self._session.clear()
+
+def _session_finish(self, *args, **kwargs):
+    # cookie 必须在输出 header 之前写入
+    if self._session.client_side:
+        _save_session(self)
+    super(self.__class__, self).finish(*args, **kwargs)
+    if not self._session.client_side:
+        _save_session(self)
+
+def _bind_session(self, settings):
+    '''
+    绑定 session 对象, 不读取存储; 存储类型不存在时返回 False
+    '''
+    session_name = settings.get('name', 'PYSESSID')
+    session_storage = settings.get('storage', 'Mongod')
+    session_config = settings.get('config', {})
+
+    if not hasattr(Xsession, session_storage):
+        return False
+
+    Session = getattr(Xsession, session_storage)
+    self._session_future = None
+
+    if Session.client_side:
+        # 数据存放在 cookie 中, 不需要单独的 session id cookie
+        self._session = Session(handler=self, name=session_name, **session_config)
+    elif self.get_secure_cookie(session_name):
+        self._session = Session(self.get_secure_cookie(session_name), **session_config)
+    else:
+        session = Session(**session_config)
+        self.set_secure_cookie(session_name , session.id)
+        self._session = session
+
+        # 新 session, 没有数据需要读取
+        self.session = self._session.create()
+
+    self.finish = functools.partial(_session_finish, self)
+    return True
+
+def load_session(self):
+    '''
+    按需读取 session, 返回 Future, 同一请求只读取一次
+
+    ``` python
+
+    class Handler(RequestHandler):
+        lazy_session = True
+
+        @session
+        @gen.coroutine
+        def get(self):
+            data = yield self.load_session()
+
+    ```
+
+    没有配置 session 或存储类型不存在时返回结果为 None 的 Future。
+    读取完成后清除已缓存的 `current_user`, 之后访问时按 session 重新取得。
+    '''
+    future = getattr(self, '_session_future', None)
+    if future:
+        return future
+
+    future = Future()
+    if not hasattr(self, '_session'):
+        future.set_result(None)
+        return future
+
+    self._session_future = future
+    if hasattr(self, 'session'):
+        future.set_result(self.session)
+        return future
+
+    def _callback(data):
+        # 与 session 对象共用同一份数据, 改动由 flush 合并写入
+        self.session = data
+        # lazy_session 时 current_user 可能在读取前已缓存为空
+        if hasattr(self, '_current_user'):
+            del self._current_user
+        future.set_result(data)
+
+    self._session.get_all(callback=_callback)
+    return future
+
 def session(method):
     '''
     异步 session 的绑定
+
+    请求没有 session cookie 时不读取存储; handler 设置了 `lazy_session = True` 时,
+    get / post 等请求方法执行前不读取, 由 handler 在需要时通过 `load_session` 读取,
+    acl 取角色等其它绑定了 session 的方法仍会先读取。此时在 `load_session` 完成之前
+    访问 `current_user` 得到的是空值, 读取完成后会重新取得。
     '''
     @asynchronous
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        if hasattr(self, '_session'):
-            return method(self, *args, **kwargs)
-
-        settings = config.get('session', False)
+        if not hasattr(self, '_session'):
+            settings = config.get('session', False)
+            if not settings or not _bind_session(self, settings):
+                return method(self, *args, **kwargs)
 
-        if settings:
-            session_name = settings.get('name', 'PYSESSID')
-            session_storage = settings.get('storage', 'Mongod')
-            session_config = settings.get('config', {})
-           
-            if hasattr(Xsession, session_storage):
+        if hasattr(self, 'session'):
+            return method(self, *args, **kwargs)
 
-                Session = getattr(Xsession, session_storage)
+        if getattr(self, 'lazy_session', False) \
+                and method.__name__.upper() in self.SUPPORTED_METHODS:
+            return method(self, *args, **kwargs)
 
-                if self.get_secure_cookie(session_name):
-                    self._session = Session(self.get_secure_cookie(session_name), **session_config)
-                else:
-                    session = Session(**session_config)
-                    self.set_secure_cookie(session_name , session.id)
-                    self._session = session
+        IOLoop.current().add_future(load_session(self),
+                                    lambda future: method(self, *args, **kwargs))
 
-                def none_callback(*args, **kwargs):
-                    pass
+    return wrapper
 
-                def finish(self, *args, **kwargs):
-                    
-                    super(self.__class__, self).finish(*args, **kwargs)
-                    if self._session_cache != self.session:
-                        #print 'change session'
-                        if self.session:
-                            #print 'save session'
-                            self._session.storage.set(self.session, none_callback)
-                        else:
-                            #print 'clear session'
-                            self._session.clear()
-
-                @gen.engine
-                def init(self):
-                    data = yield gen.Task(self._session.get_all)
-                    self._session_cache = copy.copy(data)
-                    self.session = data
-                    self.finish = functools.partial(finish, self)
-                    method(self, *args, **kwargs)
-
-                init(self)
-        else:
-            method(self, *args, **kwargs)
+class _AclRule(object):
+    '''
+    编译后的访问规则: 同一 handler 的每条规则的 allow / deny 为 frozenset,
+    全部通过才允许访问, 按角色集合缓存判断结果
+    '''
 
-    return wrapper
+    # 最多缓存的角色集合数
+    max_decisions = 1000
+
+    def __init__(self, rules):
+        self.rules = [(frozenset(rule.get('allow') or []), frozenset(rule.get('deny') or []))
+                      for rule in rules]
+        self._decisions = {}
+
+        # 预先计算最常见的角色集合
+        for role in ('ACL_NO_ROLE', 'ACL_HAS_ROLE'):
+            self.check([role])
+
+    def check(self, roles):
+        key = frozenset(roles)
+        try:
+            return self._decisions[key]
+        except KeyError:
+            pass
+
+        # 每条规则 deny 优先, 其次 allow, 都不匹配时拒绝
+        decision = True
+        for allow, deny in self.rules:
+            if deny & key or not allow & key:
+                decision = False
+                break
+        if len(self._decisions) < self.max_decisions:
+            self._decisions[key] = decision
+        return decision
+
+def _acl_table(acls):
+    '''
+    编译访问规则: handler URI -> _AclRule
+    '''
+    rules = {}
+    for rule in acls:
+        rules.setdefault(rule['URI'], []).append(rule)
+    return dict([(URI, _AclRule(URI_rules)) for URI, URI_rules in rules.items()])
 
 def acl(method):
     '''
@@ -125,22 +243,10 @@ def acl(method):
      - ACL_NO_ROLE 没有角色用户
      - ACL_HAS_ROLE 有角色用户
 
+    规则由 `Route.acl` 编译; 没有经过 `Route.acl` 的 application,
+    首次请求时按 settings 中的 `acls` 编译。
     '''
 
-    # 检查
-    def check(rule, roles):
-        if rule.get('deny', False):
-            for r in roles:
-                if r in rule['deny']:
-                    return False
-
-        if rule.get('allow', False):
-            for r in roles:
-                if r in rule['allow']:
-                    return True
-
-        return False
-
     # 取当前用户角色
     @session
     def get_roles(self, callback=None):
@@ -173,35 +279,122 @@ def acl(method):
         self.set_header('Pragma', 'no-cache')
         self.set_header('Expires', -1)
 
-        # 唯一标识
-        URI = self.__class__.__module__ + '.' + self.__class__.__name__
-        # 访问规则
-        rules = self.settings.get('acls', [])
-
-        if len(rules) == 0:
+        # 编译后的规则表, 按 handler 的 URI 查找
+        table = self.settings.get('acl_table')
+        if table is None:
+            table = self.settings['acl_table'] = _acl_table(self.settings.get('acls', []))
+        elif 'acl_version' in self.settings \
+                and self.settings['acl_version'] != Route._acl_version:
+            # 建表后规则有变化, 重新编译
+            Route.acl(self.application)
+            table = self.settings['acl_table']
+
+        # URI 只计算一次, 存在类上 (不从父类继承)
+        handler_class = self.__class__
+        URI = handler_class.__dict__.get('_acl_uri')
+        if not URI:
+            URI = handler_class.__module__ + '.' + handler_class.__name__
+            handler_class._acl_uri = URI
+
+        rule = table.get(URI)
+        if not rule:
             return method(self, transforms, *args, **kwargs)
 
         @gen.engine
-        def init():
-            roles = False
+        def check_rule():
+            roles = yield gen.Task(get_roles, self)
+            if not rule.check(roles):
+                self._transforms = transforms
+                self.on_access_denied()
+                return
 
-            for r in rules:
-                if r['URI'] == URI:
-                    if False == roles:
-                        roles = yield gen.Task(get_roles, self)
-                        #print roles
+            method(self, transforms, *args, **kwargs)
 
-                    if False == check(r, roles):
-                        self._transforms = transforms
-                        self.on_access_denied()
-                        return #self.finish()
+        check_rule()
 
+    return wrapper
 
-            method(self, transforms, *args, **kwargs)
 
-        init()
+class _Dispatcher(object):
+    '''
+    编译后的路由表
+    ==========
 
-    return wrapper
+    没有正则语法的规则放在 dict 中按路径直接查找; 其余规则按顺序合并成
+    `(?:(规则1)|(规则2)|...)` 形式的正则, 用 `lastindex` 找到匹配的规则。
+    合并时去掉分组名(参数仍由 tornado 用原规则提取), 避免重名。
+    Python 2 的正则最多 100 个分组, 超过时分成多段; 含反向引用或内联标志、
+    无法合并的规则单独匹配。匹配结果与按顺序逐条匹配相同。
+    '''
+
+    # 每段正则最多的分组数
+    max_groups = 99
+
+    _literal = re.compile(r'^(?:[^\\.^$*+?{}\[\]|()]|\\[^A-Za-z0-9])*$')
+    _standalone = re.compile(r'\\[1-9]|\(\?P=|\(\?[iLmsux]')
+    _named_group = re.compile(r'(?<!\\)\(\?P<\w+>')
+
+    def __init__(self, specs):
+        self.specs = specs
+        # 路径 -> (序号, 规则)
+        self.static = {}
+        # (第一条规则的序号, 正则, {分组: (序号, 规则)}, 规则)
+        self.chunks = []
+
+        pending = []
+        for index, spec in enumerate(specs):
+            pattern = spec.regex.pattern
+            body = pattern[:-1] if pattern.endswith('$') else pattern
+            if not spec.regex.groups and self._literal.match(body):
+                self.static.setdefault(re.sub(r'\\(.)', r'\1', body), (index, spec))
+                continue
+
+            if self._standalone.search(pattern):
+                self._combine(pending)
+                pending = []
+                self.chunks.append((index, spec.regex, None, spec))
+                continue
+
+            groups = sum([1 + s.regex.groups for i, s in pending])
+            if groups + 1 + spec.regex.groups > self.max_groups:
+                self._combine(pending)
+                pending = []
+            pending.append((index, spec))
+
+        self._combine(pending)
+
+    def _combine(self, pending):
+        if not pending:
+            return
+
+        patterns = []
+        groups = {}
+        group = 1
+        for index, spec in pending:
+            patterns.append('(%s)' % self._named_group.sub('(', spec.regex.pattern))
+            groups[group] = (index, spec)
+            group += 1 + spec.regex.groups
+
+        regex = re.compile('(?:%s)' % '|'.join(patterns))
+        self.chunks.append((pending[0][0], regex, groups, None))
+
+    def match(self, path):
+        '''
+        返回第一条匹配 path 的规则, 没有则返回 None
+        '''
+        found = self.static.get(path)
+        for first, regex, groups, spec in self.chunks:
+            if found and first > found[0]:
+                break
+
+            m = regex.match(path)
+            if m:
+                index, spec = groups[m.lastindex] if groups else (first, spec)
+                if not found or index < found[0]:
+                    return spec
+                break
+
+        return found[1] if found else None
 
 
 class Route(object):
@@ -227,6 +420,16 @@ class Route(object):
     _routes = {}
     # 访问规则
     _acl = []
+    # 访问规则的版本, 规则变化时加一, 用于判断编译后的规则表是否过期
+    _acl_version = 0
+    # 重新加载中的模块原有的路由, 重新注册时原位替换
+    _stale = {}
+    # 路由名 -> 路由
+    _named = {}
+    # url_for 的结果
+    _urls = {}
+    # 最多缓存的 url 数
+    max_urls = 1000
     
     def __init__(self, pattern, name=None, host='.*$', allow=None, deny=None, **kwargs):
         self.pattern = pattern
@@ -246,13 +449,14 @@ class Route(object):
         deny  = self.deny 
         
         if allow or deny:
-            index = False
+            Route._acl_version += 1
+            index = None
             for acl in self._acl:
                 if acl['URI'] == URI:
                     index = self._acl.index(acl)
                     break
      
-            if False == index:
+            if index is None:
                 item = {'URI' : URI, 'allow' : [], 'deny' : []}
                 self._acl.append(item)
                 index = self._acl.index(item)
@@ -269,9 +473,34 @@ class Route(object):
                     
         spec = url(self.pattern, handler_class, self.kwargs, name=name)
 
-        self._routes.setdefault(self.host, [])
-        if spec not in self._routes[self.host]:
-            self._routes[self.host].append(spec)
+        specs = self._routes.setdefault(self.host, [])
+        index = None
+        for old in self._stale.get(handler_class.__module__, []):
+            if old.handler_class.__name__ == handler_class.__name__ \
+                    and old.regex.pattern == spec.regex.pattern and old in specs:
+                index = specs.index(old)
+                self._stale[handler_class.__module__].remove(old)
+                break
+
+        if index is None:
+            # 模块被直接 reload 时, 同一 host / 规则 / handler 的路由也原位替换, 不重复添加
+            for i, old in enumerate(specs):
+                if old.regex.pattern == spec.regex.pattern \
+                        and old.handler_class.__module__ == handler_class.__module__ \
+                        and old.handler_class.__name__ == handler_class.__name__:
+                    index = i
+                    break
+
+        if index is not None:
+            specs[index] = spec
+        elif specs and specs[-1].handler_class is _404Handler:
+            # 404 始终在最后
+            specs.insert(len(specs) - 1, spec)
+        else:
+            specs.append(spec)
+
+        self._named[name] = spec
+        self._urls.clear()
 
         # 存放路由规则
         if False == hasattr(handler_class, 'routes'):
@@ -291,7 +520,64 @@ class Route(object):
     @classmethod
     def reset(cls):
         cls._acl = []
+        Route._acl_version += 1
         cls._routes = {}
+        cls._named = {}
+        cls._urls = {}
+
+    @classmethod
+    def _unname(cls, specs):
+        # 从路由名索引中移除
+        for spec in specs:
+            if cls._named.get(spec.name) is spec:
+                del cls._named[spec.name]
+        cls._urls.clear()
+
+    @classmethod
+    def _take(cls, module_name):
+        # 模块注册的路由和访问规则
+        specs = [spec for host_specs in cls._routes.values() for spec in host_specs
+                 if spec.handler_class.__module__ == module_name]
+        acls = [acl for acl in cls._acl if acl['URI'].rsplit('.', 1)[0] == module_name]
+        return specs, acls
+
+    @classmethod
+    def discard(cls, module_name):
+        '''
+        移除模块注册的路由和访问规则
+        '''
+        specs, acls = cls._take(module_name)
+        for host_specs in cls._routes.values():
+            host_specs[:] = [spec for spec in host_specs if spec not in specs]
+        cls._acl[:] = [acl for acl in cls._acl if acl not in acls]
+        Route._acl_version += 1
+        cls._unname(specs)
+
+    @classmethod
+    def reload(cls, module):
+        '''
+        重新加载模块: 重新注册的路由原位替换原来的路由, 不再注册的移除;
+        加载失败时保留原来的路由和访问规则
+        '''
+        name = module.__name__
+        specs, acls = cls._take(name)
+        cls._acl[:] = [acl for acl in cls._acl if acl not in acls]
+        Route._acl_version += 1
+        cls._stale[name] = specs
+
+        try:
+            reload(module)
+        except Exception:
+            del cls._stale[name]
+            cls._acl.extend(acls)
+            Route._acl_version += 1
+            raise
+
+        stale = cls._stale.pop(name)
+        for host_specs in cls._routes.values():
+            host_specs[:] = [spec for spec in host_specs if spec not in stale]
+        cls._unname(stale)
+        return module
 
     @classmethod
     def reset_handlers(cls,application):
@@ -312,13 +598,15 @@ class Route(object):
 
                 item = url(pattern, static_handler_class, static_handler_args)
                 cls._routes.setdefault('.*$', [])
-                if item not in cls._routes['.*$'] :
+                # 路由不再整体重置, 按规则判断是否已添加
+                patterns = [spec.regex.pattern for spec in cls._routes['.*$']]
+                if item.regex.pattern not in patterns:
                     cls._routes['.*$'].insert(0, item) 
 
         # 404
         item = url(r"/(.+)$", _404Handler)
 
-        if cls._routes.get('.*$') and item not in cls._routes['.*$'] :
+        if cls._routes.get('.*$') and cls._routes['.*$'][-1].handler_class is not _404Handler:
             cls._routes['.*$'].append(item) 
          
         application.handlers = []
@@ -329,6 +617,8 @@ class Route(object):
     def acl(cls, application=None):
         if application:
             application.settings['acls'] = cls._acl
+            application.settings['acl_table'] = _acl_table(cls._acl)
+            application.settings['acl_version'] = Route._acl_version
         else:
             return cls._acl
     
@@ -339,33 +629,73 @@ class Route(object):
             for host, handlers in cls._routes.items():
                 application.add_handlers(host, handlers)
 
+            # 编译路由表
+            application._dispatchers = dict([(id(specs), _Dispatcher(specs))
+                                             for pattern, specs in application.handlers])
+
         else:
             return reduce(lambda x,y:x+y, cls._routes.values()) if cls._routes else []
 
     @classmethod
     def url_for(cls, name, *args):
-        named_handlers = dict([(spec.name, spec) for spec in cls.routes() if spec.name])
-        if name in named_handlers:
-            return named_handlers[name].reverse(*args)
-        raise KeyError("%s not found in named urls" % name)
+        key = (name, args)
+        try:
+            return cls._urls[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # 参数不可哈希, 不缓存
+            key = None
+
+        spec = cls._named.get(name)
+        if not spec:
+            # 索引中没有(如同名路由被移除), 逐条查找
+            named_handlers = dict([(spec.name, spec) for spec in cls.routes() if spec.name])
+            if name not in named_handlers:
+                raise KeyError("%s not found in named urls" % name)
+            spec = cls._named[name] = named_handlers[name]
+
+        path = spec.reverse(*args)
+        if key is not None:
+            if len(cls._urls) >= cls.max_urls:
+                cls._urls.clear()
+            cls._urls[key] = path
+        return path
 
 route = Route
 
+def _module_mtime(module):
+    # 模块源文件的修改时间
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+    if path[-4:] in ('.pyc', '.pyo') and os.path.exists(path[:-1]):
+        path = path[:-1]
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
 def sync_app(method):
     '''
     同步各个app
+
+    请求本身不再读取同步 id, 收到第一个请求时(此时 IOLoop 已在运行,
+    fork 之后)启动定时检查, 每 `sync_interval` 秒读取一次;
+    同时预热 session 存储的连接, 避免 fork 出的子进程共用父进程的连接
     '''
 
     @functools.wraps(method)
-    @gen.engine
     def wrapper(self, request):
-        if self.cache:
-            sync_id = yield gen.Task(self.cache.get, self._sync_key, 0)
-            #print sync_id
-            if sync_id != self._sync_id:
-                #print '同步'
-                ret = yield gen.Task(self.sync, sync_id)
-        method(self, request)
+        if self._session_storage:
+            Session, self._session_storage = self._session_storage, None
+            Session.warm_up(**(config.get('session') or {}).get('config', {}))
+
+        if self.cache and not self._sync_timer:
+            self._sync_timer = PeriodicCallback(self._check_sync,
+                                                int(self._sync_interval * 1000))
+            self._sync_timer.start()
+        return method(self, request)
 
     return wrapper
 
@@ -383,14 +713,25 @@ class Application(Application):
                 autoescape = settings['autoescape']
             )
 
+        # 模块修改时间, 同步时只重新加载有改动的模块
+        self._mtimes = {}
+        self._handler_names = set()
+
         # 初始化 app 缓存
         self.cache = False
-        cache_cfg = config.get('cache', False)
+        cache_cfg = config.get('cache') or {}
         cache_storage = cache_cfg.get('storage', 'Mongod')
         if cache_cfg and hasattr(cache, cache_storage):
             Cache = getattr(cache, cache_storage)
             self.cache = Cache(**cache_cfg.get('config', {}))
+            # 进程内缓存
+            if cache_cfg.get('local'):
+                self.cache = cache.Tiered(self.cache, **cache_cfg['local'])
             self._sync_key = settings.get('sync_key', 'xcat.web.Application.id')
+            # 检查同步 id 的间隔(秒)
+            self._sync_interval = settings.get('sync_interval', 1)
+            self._sync_timer = None
+            self._sync_checking = False
             
         ret = super(Application,self).__init__(
             [],
@@ -400,13 +741,78 @@ class Application(Application):
             **settings
         )
 
+        # session 存储: 此时可能还未 fork, 只做不建立连接的准备,
+        # 连接在收到第一个请求时预热 (见 sync_app)
+        self._session_storage = None
+        session_cfg = config.get('session') or {}
+        session_storage = session_cfg.get('storage', 'Mongod')
+        if session_cfg and hasattr(Xsession, session_storage):
+            self._session_storage = getattr(Xsession, session_storage)
+            self._session_storage.prepare(**session_cfg.get('config', {}))
+
         route.acl(self)
         route.routes(self)
 
+        # 记录 handler 模块当前的修改时间
+        if settings.get('app_path'):
+            handlers, modules = self._handler_modules()
+            self._module_changed(handlers)
+            for module, submodules in modules:
+                self._handler_names.add(module.__name__)
+                for o in [module] + submodules:
+                    self._module_changed(o)
+
         self.initialize(**settings)
 
         return ret
 
+    def _module_changed(self, module):
+        # 与记录的修改时间比较, 第一次见到的模块只记录
+        mtime = _module_mtime(module)
+        return self._mtimes.setdefault(module.__name__, mtime) != mtime
+
+    def _handler_modules(self):
+        '''
+        app 的 handlers 包, 以及 `__all__` 中的模块和它们引用的 .handlers. 子模块
+        '''
+        app_handlers = self.settings['app_path'].split(os.path.sep).pop() + '.handlers'
+        handlers = import_object(app_handlers)
+
+        modules = []
+        for name in handlers.__all__:
+            handler_module = import_object(app_handlers + '.' + name)
+            submodules = []
+            for v in dir(handler_module):
+                o = getattr(handler_module, v)
+                if type(o) is types.ModuleType \
+                   and o.__name__.find('.handlers.') != -1:
+                    submodules.append(o)
+            modules.append((handler_module, submodules))
+
+        return handlers, modules
+
+    def reload_module(self, module, force=False):
+        '''
+        模块文件有改动(或 `force`)时重新加载, 原位替换它注册的路由和访问规则,
+        返回是否重新加载
+        '''
+        if not force and not self._module_changed(module):
+            return False
+
+        route.reload(module)
+        self._mtimes[module.__name__] = _module_mtime(module)
+        return True
+
+    def discard_module(self, module_name):
+        # 移除模块注册的路由和访问规则
+        route.discard(module_name)
+        self._mtimes.pop(module_name, None)
+
+    def refresh_routes(self):
+        # 按当前的路由和访问规则重建 app 的 handlers
+        route.acl(self)
+        route.routes(self)
+
     @gen.engine
     def sync_ping(self, callback=None):
         # 更新同步信号 
@@ -418,27 +824,57 @@ class Application(Application):
             callback(True)
 
     @gen.engine
-    def sync(self, sync_id, callback=None):
-        route.reset()
-
-        # 重新加载 app handlers
-        app_handlers = self.settings['app_path'].split(os.path.sep).pop() + '.handlers'
-        handlers = import_object(app_handlers)
+    def _check_sync(self):
+        # 定时检查其它节点是否发出了同步信号
+        if self._sync_checking:
+            return
 
-     
-        for name in handlers.__all__:
-            handler_module = import_object(app_handlers + '.' + name)
-            reload(handler_module)
-            for v in dir(handler_module):
-                o = getattr(handler_module,v)      
-                if type(o) is types.ModuleType\
-                   and o.__name__.find('.handlers.') != -1:
-                    reload(o)
+        self._sync_checking = True
+        try:
+            sync_id = yield gen.Task(self.cache.get, self._sync_key, 0)
+            if sync_id != self._sync_id:
+                yield gen.Task(self.sync, sync_id)
+        finally:
+            self._sync_checking = False
 
-        #print route._routes
+    @gen.engine
+    def sync(self, sync_id, callback=None):
+        '''
+        只重新加载源文件有改动的 handler 模块(及引用了改动子模块的模块),
+        每加载一个模块让出一次 IOLoop, 加载期间请求仍按原来的路由处理
+        '''
+        io_loop = IOLoop.current()
 
-        route.acl(self)
-        route.routes(self)
+        # handlers 包有改动时先重新加载, 取得新的 __all__
+        app_handlers = self.settings['app_path'].split(os.path.sep).pop() + '.handlers'
+        self.reload_module(import_object(app_handlers))
+        handlers, modules = self._handler_modules()
+
+        names = set()
+        reloaded = set()
+        for handler_module, submodules in modules:
+            names.add(handler_module.__name__)
+
+            force = False
+            for o in submodules:
+                if o.__name__ in reloaded:
+                    force = True
+                elif self.reload_module(o):
+                    reloaded.add(o.__name__)
+                    force = True
+                    yield gen.Task(io_loop.add_callback)
+
+            # 引用的子模块重新加载后, 引用它的模块也要重新加载
+            if self.reload_module(handler_module, force):
+                reloaded.add(handler_module.__name__)
+                yield gen.Task(io_loop.add_callback)
+
+        # 不再列在 __all__ 中的模块, 移除它注册的路由
+        for name in self._handler_names - names:
+            self.discard_module(name)
+        self._handler_names = names
+
+        self.refresh_routes()
         self.initialize(**self.settings)
       
         # 标记已同步
@@ -451,6 +887,32 @@ class Application(Application):
     def __call__(self, request):
         return super(Application, self).__call__(request)
 
+    def _get_host_handlers(self, request):
+        '''
+        用编译后的路由表查找, 只返回匹配的规则;
+        路由表不是最新的或没有匹配时, 交给 tornado 逐条匹配
+        '''
+        host = request.host.lower().split(':')[0]
+        entries = [specs for pattern, specs in self.handlers if pattern.match(host)]
+        # 与 tornado 一致, 没有匹配的 host 时使用默认 host
+        if not entries and 'X-Real-Ip' not in request.headers:
+            entries = [specs for pattern, specs in self.handlers
+                       if pattern.match(self.default_host)]
+        if not entries:
+            return None
+
+        dispatchers = getattr(self, '_dispatchers', {})
+        for specs in entries:
+            dispatcher = dispatchers.get(id(specs))
+            if not dispatcher or dispatcher.specs is not specs:
+                break
+
+            spec = dispatcher.match(request.path)
+            if spec:
+                return [spec]
+
+        return reduce(lambda x, y: x + y, entries)
+
     @plugins.init
     @gen.engine
     def initialize(self, **settings):
@@ -531,6 +993,10 @@ class RequestHandler(RequestHandler):
         )
         return template.render(**context)
 
+    def load_session(self):
+        # 按需读取 session, 见 load_session
+        return load_session(self)
+
     @session
     def set_current_user(self,session):
         if hasattr(self, 'session'):